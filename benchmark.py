@@ -0,0 +1,591 @@
+""" Offline benchmark for localwriter.
+
+Runs MainJob.trigger against fake Writer/Calc documents and a local stub
+OpenAI compatible /v1/completions server, so localwriter's own overhead can be
+measured separately from model speed. No LibreOffice installation is needed:
+minimal stand-ins for the uno/unohelper modules are installed before main.py
+is imported.
+
+    python benchmark.py                      # default scenarios
+    python benchmark.py --latency 0.2 --token-rate 50 --cells 10,100
+    python benchmark.py --no-stream > bench_output.txt
+
+For every scenario it reports the end-to-end time (trigger until the last
+document update) and how much time went to get_config, calls on the fake UNO
+objects and HTTP. Time spent on worker threads is summed over all threads,
+so with concurrency the parts can add up to more than the total.
+"""
+import argparse
+import http.server
+import json
+import logging
+import os
+import shutil
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import types
+
+
+# ---------------------------------------------------------------------------
+# stand-ins for the UNO runtime
+
+class Timer:
+    # accumulates seconds per category from any thread
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.seconds = {}
+            self.calls = {}
+
+    def add(self, category, seconds):
+        with self.lock:
+            self.seconds[category] = self.seconds.get(category, 0.0) + seconds
+            self.calls[category] = self.calls.get(category, 0) + 1
+
+
+timer = Timer()
+
+
+def timed_uno(cls):
+    # counts every public method call on a fake UNO object as UNO time
+    for name, value in list(vars(cls).items()):
+        if callable(value) and not name.startswith("_"):
+            def wrapper(self, *args, _func=value):
+                started = time.perf_counter()
+                try:
+                    return _func(self, *args)
+                finally:
+                    timer.add("uno", time.perf_counter() - started)
+            setattr(cls, name, wrapper)
+    return cls
+
+
+def install_fake_uno(config_dir):
+    """ Registers minimal uno, unohelper, officehelper and com.sun.star modules."""
+    def module(name, **attrs):
+        mod = types.ModuleType(name)
+        mod.__dict__.update(attrs)
+        sys.modules[name] = mod
+        return mod
+
+    class Base:
+        pass
+
+    class Interface:
+        pass
+
+    class ImplementationHelper:
+        def addImplementation(self, *args):
+            pass
+
+    module("uno",
+           fileUrlToSystemPath=lambda url: url[len("file://"):],
+           systemPathToFileUrl=lambda path: "file://" + path,
+           getComponentContext=lambda: None,
+           createUnoStruct=lambda name, *args: None)
+    module("unohelper", Base=Base, ImplementationHelper=ImplementationHelper)
+    module("officehelper", bootstrap=lambda: None)
+    module("com")
+    module("com.sun")
+    module("com.sun.star")
+    module("com.sun.star.task", XJobExecutor=type("XJobExecutor", (Interface,), {}), XJob=type("XJob", (Interface,), {}))
+    module("com.sun.star.awt", XCallback=Interface,
+           MessageBoxButtons=types.SimpleNamespace(BUTTONS_OK=1))
+    module("com.sun.star.awt.MessageBoxType", INFOBOX=1, ERRORBOX=2, WARNINGBOX=3)
+    module("com.sun.star.sheet")
+    module("com.sun.star.sheet.CellFlags", ANNOTATION=8)
+
+
+class MainLoop:
+    # plays the office main thread: AsyncCallback queues, run() drains the queue
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = []
+
+    def add(self, callback, data):
+        with self.lock:
+            self.pending.append((callback, data))
+
+    def run_until(self, condition, timeout=600):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.lock:
+                pending, self.pending = self.pending, []
+            for callback, data in pending:
+                callback.notify(data)
+            if not pending and condition():
+                return True
+            if not pending:
+                time.sleep(0.001)
+        raise RuntimeError("benchmark scenario timed out")
+
+
+main_loop = MainLoop()
+
+
+@timed_uno
+class FakeText:
+    def __init__(self, string):
+        self.string = string
+        self.ranges = []
+
+    def createTextCursorByRange(self, text_range):
+        return FakeRange(self, text_range.start, text_range.end)
+
+    def insertString(self, cursor, string, absorb):
+        position = cursor.start
+        self.string = self.string[:position] + string + self.string[position:]
+        for text_range in self.ranges:
+            if text_range is cursor:
+                continue
+            if text_range.start > position:
+                text_range.start += len(string)
+            if text_range.end >= position:
+                text_range.end += len(string)
+        cursor.start = cursor.end = position + len(string)
+
+    def compareRegionStarts(self, a, b):
+        return (b.start > a.start) - (b.start < a.start)
+
+    def compareRegionEnds(self, a, b):
+        return (b.end > a.end) - (b.end < a.end)
+
+
+@timed_uno
+class FakeRange:
+    # a text range, cursor or paragraph: [start, end) into FakeText.string, "\n" separates paragraphs
+    def __init__(self, text, start, end):
+        self.text = text
+        self.start = start
+        self.end = end
+        text.ranges.append(self)
+
+    def getString(self):
+        return self.text.string[self.start:self.end]
+
+    def setString(self, string):
+        text = self.text
+        text.string = text.string[:self.start] + string + text.string[self.end:]
+        delta = len(string) - (self.end - self.start)
+        for text_range in text.ranges:
+            if text_range is self:
+                continue
+            if text_range.start >= self.end:
+                text_range.start += delta
+            elif text_range.start > self.start:
+                text_range.start = self.start
+            if text_range.end >= self.end:
+                text_range.end += delta
+            elif text_range.end > self.start:
+                text_range.end = self.start
+        self.end = self.start + len(string)
+
+    def getText(self):
+        return self.text
+
+    def getStart(self):
+        return FakeRange(self.text, self.start, self.start)
+
+    def getEnd(self):
+        return FakeRange(self.text, self.end, self.end)
+
+    def gotoRange(self, text_range, expand):
+        if expand:
+            self.end = text_range.end
+        else:
+            self.start = self.end = text_range.start
+
+    def goRight(self, count, expand):
+        if self.end + count > len(self.text.string):
+            return False
+        self.end += count
+        if not expand:
+            self.start = self.end
+        return True
+
+    def goLeft(self, count, expand):
+        if self.start - count < 0:
+            return False
+        self.start -= count
+        if not expand:
+            self.end = self.start
+        return True
+
+    def collapseToStart(self):
+        self.end = self.start
+
+    def collapseToEnd(self):
+        self.start = self.end
+
+    def gotoStartOfParagraph(self, expand):
+        self.start = self.text.string.rfind("\n", 0, self.start) + 1
+        if not expand:
+            self.end = self.start
+        return True
+
+    def gotoPreviousParagraph(self, expand):
+        if self.start == 0:
+            return False
+        self.start = self.text.string.rfind("\n", 0, self.start - 1) + 1
+        if not expand:
+            self.end = self.start
+        return True
+
+    def supportsService(self, name):
+        return name == "com.sun.star.text.Paragraph"
+
+    def createEnumeration(self):
+        paragraphs = []
+        position = 0
+        for line in self.text.string.split("\n"):
+            if position + len(line) >= self.start and position <= self.end:
+                paragraphs.append(FakeRange(self.text, position, position + len(line)))
+            position += len(line) + 1
+        return FakeEnumeration(paragraphs)
+
+
+class FakeEnumeration:
+    def __init__(self, items):
+        self.items = list(items)
+
+    def hasMoreElements(self):
+        return bool(self.items)
+
+    def nextElement(self):
+        return self.items.pop(0)
+
+
+class FakeSelection:
+    def __init__(self, ranges):
+        self.ranges = ranges
+
+    def getCount(self):
+        return len(self.ranges)
+
+    def getByIndex(self, index):
+        return self.ranges[index]
+
+
+class FakeController:
+    def __init__(self, selection, sheet=None):
+        self.Selection = selection
+        self.ActiveSheet = sheet
+
+    def getSelection(self):
+        return self.Selection
+
+
+class FakeUndoManager:
+    def __init__(self):
+        self.title = ""
+
+    def enterUndoContext(self, title):
+        self.title = title
+
+    def enterHiddenUndoContext(self):
+        pass
+
+    def leaveUndoContext(self):
+        pass
+
+    def getCurrentUndoActionTitle(self):
+        return self.title
+
+
+@timed_uno
+class FakeDocument:
+    def getUndoManager(self):
+        return FakeUndoManager()
+
+    def lockControllers(self):
+        pass
+
+    def unlockControllers(self):
+        pass
+
+
+class FakeWriterDocument(FakeDocument):
+    def __init__(self, string, start, end):
+        self.Text = FakeText(string)
+        self.CurrentController = FakeController(FakeSelection([FakeRange(self.Text, start, end)]))
+
+
+@timed_uno
+class FakeCellRange:
+    def __init__(self, sheet, start_col, start_row, end_col, end_row):
+        self.sheet = sheet
+        self.address = types.SimpleNamespace(StartColumn=start_col, StartRow=start_row, EndColumn=end_col, EndRow=end_row, Sheet=0)
+
+    def getRangeAddress(self):
+        return self.address
+
+    def getDataArray(self):
+        a = self.address
+        return tuple(tuple(self.sheet.cells.get((col, row), "") for col in range(a.StartColumn, a.EndColumn + 1))
+                     for row in range(a.StartRow, a.EndRow + 1))
+
+    def setDataArray(self, data):
+        a = self.address
+        for r, row in enumerate(data):
+            for c, value in enumerate(row):
+                self.sheet.cells[(a.StartColumn + c, a.StartRow + r)] = value
+
+    def getCellRangeByPosition(self, start_col, start_row, end_col, end_row):
+        a = self.address
+        return FakeCellRange(self.sheet, a.StartColumn + start_col, a.StartRow + start_row, a.StartColumn + end_col, a.StartRow + end_row)
+
+    def queryContentCells(self, flags):
+        # the benchmark cells have no notes
+        return types.SimpleNamespace(getRangeAddresses=lambda: ())
+
+    def supportsService(self, name):
+        return name == "com.sun.star.sheet.SheetCellRange"
+
+
+@timed_uno
+class FakeSheet:
+    def __init__(self, cells):
+        self.cells = dict(cells)
+
+    def getCellRangeByPosition(self, start_col, start_row, end_col, end_row):
+        return FakeCellRange(self, start_col, start_row, end_col, end_row)
+
+
+@timed_uno
+class FakeSheets:
+    def __init__(self, sheets):
+        self.sheets = sheets
+
+    def getByIndex(self, index):
+        return self.sheets[index]
+
+
+@timed_uno
+class FakeCalcDocument(FakeDocument):
+    def __init__(self, rows):
+        self.sheet = FakeSheet({(0, row): "cell value %d" % row for row in range(rows)})
+        self.Sheets = FakeSheets([self.sheet])
+        self.CurrentController = FakeController(FakeCellRange(self.sheet, 0, 0, 0, rows - 1), self.sheet)
+        self.automatic_calculation = True
+
+    def isAutomaticCalculationEnabled(self):
+        return self.automatic_calculation
+
+    def enableAutomaticCalculation(self, enabled):
+        self.automatic_calculation = enabled
+
+
+class FakeServiceManager:
+    def __init__(self, config_dir):
+        self.config_dir = config_dir
+        self.component = None
+
+    def createInstanceWithContext(self, name, ctx):
+        started = time.perf_counter()
+        try:
+            if name == "com.sun.star.frame.Desktop":
+                return types.SimpleNamespace(getCurrentComponent=lambda: self.component,
+                                             getCurrentFrame=lambda: None)
+            if name == "com.sun.star.util.PathSettings":
+                return types.SimpleNamespace(UserConfig="file://" + self.config_dir)
+            if name == "com.sun.star.awt.AsyncCallback":
+                return types.SimpleNamespace(addCallback=main_loop.add)
+            raise RuntimeError("service not available in the benchmark: " + name)
+        finally:
+            timer.add("uno", time.perf_counter() - started)
+
+
+class FakeContext:
+    def __init__(self, service_manager):
+        self.ServiceManager = service_manager
+
+    def getServiceManager(self):
+        return self.ServiceManager
+
+
+# ---------------------------------------------------------------------------
+# stub backend
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    # /v1/completions that answers after `latency` seconds at `token_rate` tokens per second
+    protocol_version = "HTTP/1.1"
+    latency = 0.05
+    token_rate = 200.0
+
+    def setup(self):
+        super().setup()
+        # every SSE chunk is a small send; with Nagle's algorithm and the client's delayed ACK
+        # each response on a reused connection would wait ~40 ms for no reason
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path != "/v1/completions":
+            self.send_error(404)
+            return
+        tokens = max(1, min(int(data.get("max_tokens", 16)), 64))
+        time.sleep(self.latency)
+        if data.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for _ in range(tokens):
+                time.sleep(1.0 / self.token_rate)
+                self.chunk(b"data: " + json.dumps({"choices": [{"text": " tok"}]}).encode() + b"\n\n")
+            self.chunk(b"data: [DONE]\n\n")
+            self.chunk(b"")
+            return
+        time.sleep(tokens / self.token_rate)
+        body = json.dumps({"choices": [{"text": " tok" * tokens}],
+                           "usage": {"prompt_tokens": 10, "completion_tokens": tokens}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def chunk(self, data):
+        self.wfile.write(b"%x\r\n" % len(data) + data + b"\r\n")
+        self.wfile.flush()
+
+
+class StubServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+# ---------------------------------------------------------------------------
+
+def instrument(main):
+    # time get_config and everything the connection pool does
+    get_config = main.MainJob.get_config
+
+    def timed_get_config(self, key, default):
+        started = time.perf_counter()
+        try:
+            return get_config(self, key, default)
+        finally:
+            timer.add("get_config", time.perf_counter() - started)
+    main.MainJob.get_config = timed_get_config
+
+    def timed(category, func):
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timer.add(category, time.perf_counter() - started)
+        return wrapper
+    post = timed("http", main.ConnectionPool.post)
+
+    def counted_post(*args, **kwargs):
+        timer.add("requests", 0.0)
+        return post(*args, **kwargs)
+    main.ConnectionPool.post = counted_post
+    main.PooledResponse.read = timed("http", main.PooledResponse.read)
+
+    iterate = main.PooledResponse.__iter__
+
+    def timed_iter(self):
+        lines = iterate(self)
+        while True:
+            started = time.perf_counter()
+            try:
+                line = next(lines)
+            except StopIteration:
+                return
+            finally:
+                timer.add("http", time.perf_counter() - started)
+            yield line
+    main.PooledResponse.__iter__ = timed_iter
+
+
+def run_scenario(main, service_manager, name, command, document, instructions="rewrite this"):
+    job = main.MainJob(FakeContext(service_manager))
+    job.input_box = lambda *args, **kwargs: instructions
+    service_manager.component = document
+    timer.reset()
+    started = time.perf_counter()
+    job.trigger(command)
+    main_loop.run_until(lambda: not main._executor.jobs)
+    elapsed = time.perf_counter() - started
+    seconds = dict(timer.seconds)
+    calls = dict(timer.calls)
+    return {"scenario": name, "total_s": elapsed,
+            "get_config_s": seconds.get("get_config", 0.0), "get_config_calls": calls.get("get_config", 0),
+            "uno_s": seconds.get("uno", 0.0), "uno_calls": calls.get("uno", 0),
+            "http_s": seconds.get("http", 0.0), "requests": calls.get("requests", 0)}
+
+
+def main_benchmark(argv=None):
+    parser = argparse.ArgumentParser(description="Measure localwriter's overhead against a stub backend.")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds before the stub answers (default 0.05)")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="tokens per second the stub generates (default 200)")
+    parser.add_argument("--max-tokens", type=int, default=16, help="extend_selection_max_tokens (default 16)")
+    parser.add_argument("--cells", default="10,100,1000", help="Calc range sizes (default 10,100,1000)")
+    parser.add_argument("--concurrency", type=int, default=4, help="calc_concurrency (default 4)")
+    parser.add_argument("--no-stream", action="store_true", help="benchmark with streaming disabled")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per scenario")
+    args = parser.parse_args(argv)
+
+    config_dir = tempfile.mkdtemp(prefix="localwriter-bench-")
+    install_fake_uno(config_dir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    # keep the benchmark out of ~/log.txt
+    logging.getLogger("localwriter").addHandler(logging.NullHandler())
+    import main
+    instrument(main)
+
+    StubHandler.latency = args.latency
+    StubHandler.token_rate = args.token_rate
+    server = StubServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with open(os.path.join(config_dir, "localwriter.json"), "w") as file:
+        json.dump({"endpoint": "http://127.0.0.1:%d" % server.server_address[1],
+                   "stream": not args.no_stream,
+                   "extend_selection_max_tokens": args.max_tokens,
+                   "edit_selection_max_new_tokens": 0,
+                   "calc_concurrency": args.concurrency}, file)
+
+    service_manager = FakeServiceManager(config_dir)
+    paragraph = "This is a paragraph of a fairly ordinary document that is used for the benchmark."
+    text = "\n".join([paragraph] * 20)
+    scenarios = [
+        ("ExtendSelection (Writer)", "ExtendSelection", lambda: FakeWriterDocument(text, len(text) - len(paragraph), len(text))),
+        ("EditSelection (Writer)", "EditSelection", lambda: FakeWriterDocument(text, len(text) - len(paragraph), len(text))),
+    ]
+    for cells in [int(cells) for cells in args.cells.split(",") if cells.strip()]:
+        scenarios.append(("ExtendSelection (Calc, %d cells)" % cells, "ExtendSelection", lambda cells=cells: FakeCalcDocument(cells)))
+        scenarios.append(("EditSelection (Calc, %d cells)" % cells, "EditSelection", lambda cells=cells: FakeCalcDocument(cells)))
+
+    try:
+        results = [run_scenario(main, service_manager, name, command, make_document()) for name, command, make_document in scenarios]
+    finally:
+        server.shutdown()
+        shutil.rmtree(config_dir, ignore_errors=True)
+
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+        return
+    print("stub latency %.3fs, %.0f tokens/s, streaming %s, calc_concurrency %d"
+          % (args.latency, args.token_rate, "off" if args.no_stream else "on", args.concurrency))
+    print("%-34s %9s %12s %7s %10s %8s %9s %9s" % ("scenario", "total s", "get_config s", "calls", "UNO s", "calls", "HTTP s", "requests"))
+    for r in results:
+        print("%-34s %9.3f %12.4f %7d %10.4f %8d %9.3f %9d"
+              % (r["scenario"], r["total_s"], r["get_config_s"], r["get_config_calls"], r["uno_s"], r["uno_calls"], r["http_s"], r["requests"]))
+
+
+if __name__ == "__main__":
+    main_benchmark()
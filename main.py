@@ -1,39 +1,1902 @@
 import sys
 import unohelper
-import officehelper
 import json
-import urllib.request
-import urllib.parse
-from com.sun.star.task import XJobExecutor
+import io
+from com.sun.star.task import XJobExecutor, XJob
 from com.sun.star.awt import MessageBoxButtons as MSG_BUTTONS
+from com.sun.star.awt import XCallback
 import uno
 import os 
-import logging
-import re
+import time
+import queue
+import threading
+import collections
+import math
 
-from com.sun.star.beans import PropertyValue
-from com.sun.star.container import XNamed
+# The office imports this module on the first dispatch, so everything that isn't needed
+# to show a dialog (the HTTP stack, logging, thread pools, hashing) is imported where it
+# is used instead: the first request pays for it on the worker thread.
 
 
 def log_to_file(message):
-    # Get the user's home directory
-    home_directory = os.path.expanduser('~')
-    
-    # Define the log file path
-    log_file_path = os.path.join(home_directory, 'log.txt')
-    
-    # Set up logging configuration
-    logging.basicConfig(filename=log_file_path, level=logging.INFO, format='%(asctime)s - %(message)s')
-    
+    import logging
+    # The handler is set up once on a dedicated logger instead of calling
+    # logging.basicConfig (and touching the root logger) on every message
+    logger = logging.getLogger("localwriter")
+    if not logger.handlers:
+        with _log_lock:
+            if not logger.handlers:
+                # Get the user's home directory
+                home_directory = os.path.expanduser('~')
+
+                # Define the log file path
+                log_file_path = os.path.join(home_directory, 'log.txt')
+
+                handler = logging.FileHandler(log_file_path)
+                handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+                logger.addHandler(handler)
+                logger.setLevel(logging.INFO)
+                logger.propagate = False
+
     # Log the input message
-    logging.info(message)
+    logger.info(message)
+
+_log_lock = threading.Lock()
+
+
+class MainThreadCallback(unohelper.Base, XCallback):
+    # XCallback whose notify() is run by the office main thread, see run_on_main_thread
+    def __init__(self, func):
+        self.func = func
+
+    def notify(self, data):
+        try:
+            self.func()
+        except Exception as e:
+            log_to_file("main thread callback failed: " + str(e))
+
+
+def run_on_main_thread(ctx, func):
+    # Document mutations must not happen on the worker thread, so they are
+    # queued through com.sun.star.awt.AsyncCallback and run by the main loop in order.
+    get_service(ctx, "com.sun.star.awt.AsyncCallback").addCallback(MainThreadCallback(func), None)
+
+
+def get_service(ctx, name):
+    # The Desktop, the Toolkit and AsyncCallback live as long as the office, so each is
+    # created once instead of on every dispatch (or, for AsyncCallback, every streamed chunk)
+    service = _services.get(name)
+    if service is None:
+        service = _services[name] = ctx.getServiceManager().createInstanceWithContext(name, ctx)
+    return service
+
+_services = {}
+
+
+def cached_dialog(name, window):
+    # Dialogs are built once per parent window and shown again on the next use, one built
+    # for another window (e.g. of a document that was closed since) is thrown away
+    entry = _dialogs.get(name)
+    if entry is None:
+        return None
+    if entry[0] == window:
+        return entry[1]
+    del _dialogs[name]
+    try:
+        entry[1].dispose()
+    except Exception:
+        pass
+    return None
+
+
+def store_dialog(name, window, dialog):
+    _dialogs[name] = (window, dialog)
+
+_dialogs = {}
+
+
+class GenerationJob:
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+        self.error = None
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def is_cancelled(self):
+        return self.cancelled.is_set()
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+
+class GenerationExecutor:
+    """ Owns the worker thread that runs generation jobs off the UNO dispatch thread.
+        Jobs run one after another in submission order, so two quick presses of the
+        same hotkey can't interleave their edits.
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.jobs = []
+        self.thread = None
+
+    def submit(self, name, func):
+        """ Queues func(job) to run on the worker thread and returns the GenerationJob."""
+        job = GenerationJob(name, func)
+        with self.lock:
+            self.jobs.append(job)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="localwriter-generation", daemon=True)
+                self.thread.start()
+        self.queue.put(job)
+        return job
+
+    def cancel_all(self):
+        """ Cancels the running job and everything still queued, returns how many were cancelled."""
+        with self.lock:
+            jobs = list(self.jobs)
+        for job in jobs:
+            job.cancel()
+        return len(jobs)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if not job.is_cancelled():
+                    job.func(job)
+            except Exception as e:
+                job.error = e
+                log_to_file("job " + job.name + " failed: " + str(e))
+            finally:
+                with self.lock:
+                    self.jobs.remove(job)
+                log_to_file("job " + job.name + " finished, " + _http_pool.describe_stats())
+                job.done.set()
+
+
+# MainJob instances are created per dispatch, so the executor lives at module level
+_executor = GenerationExecutor()
+
+
+class UndoGroup:
+    """ Makes all changes a job makes to a document one undo action named title.
+        Each main thread callback opens and closes its own undo context, so text the user
+        types while the job runs never ends up in it and Undo works meanwhile. Later writes
+        join the job's action through a hidden context, as long as it is still the last one;
+        after the user changed the document in between they start a new one.
+    """
+    def __init__(self, document, title):
+        self.document = document
+        self.title = title
+        self.opened = False
+
+    def run(self, func):
+        # must be called on the main thread
+        if self.document is None:
+            return func()
+        try:
+            manager = self.document.getUndoManager()
+            if self.opened and manager.getCurrentUndoActionTitle() == self.title:
+                manager.enterHiddenUndoContext()
+            else:
+                manager.enterUndoContext(self.title)
+            self.opened = True
+        except Exception as e:
+            log_to_file("could not open undo context: " + str(e))
+            return func()
+        try:
+            return func()
+        finally:
+            manager.leaveUndoContext()
+
+
+def bulk_update(document, func):
+    """ Runs func() on the main thread with the document's views locked and, in Calc,
+        automatic recalculation suspended, so many writes cause one repaint and one recalculation.
+    """
+    if document is None:
+        return func()
+    calc = hasattr(document, "Sheets")
+    document.lockControllers()
+    try:
+        if calc:
+            automatic = document.isAutomaticCalculationEnabled()
+            document.enableAutomaticCalculation(False)
+        try:
+            return func()
+        finally:
+            if calc:
+                # switching it back on recalculates what changed
+                document.enableAutomaticCalculation(automatic)
+    finally:
+        document.unlockControllers()
+
+
+def edit_tokens(text):
+    # words, runs of whitespace and single other characters, the units edits are aligned on
+    import re
+    return re.findall(r"\w+|\s+|[^\w\s]", text)
+
+
+def move_cursor(cursor, count, expand, forward=True):
+    # goRight and goLeft take a 16 bit count
+    move = cursor.goRight if forward else cursor.goLeft
+    while count > 0:
+        step = min(count, 32767)
+        move(step, expand)
+        count -= step
+
+
+def apply_text_edit(text_range, original, new_text):
+    """ Turns text_range, whose text is original, into new_text by replacing only the words
+        that changed. The formatting, comments and bookmarks of the unchanged text are kept
+        and Writer only lays out what changed. Must run on the main thread.
+        Returns the number of spans that were replaced.
+    """
+    import difflib
+    old_tokens = edit_tokens(original)
+    new_tokens = edit_tokens(new_text)
+    matcher = difflib.SequenceMatcher(None, old_tokens, new_tokens, autojunk=False)
+    text = text_range.getText()
+    cursor = text.createTextCursorByRange(text_range.getStart())
+    replaced = 0
+    # the unchanged run in front of the next change, the cursor is collapsed at its start
+    equal, equal_start = "", 0
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            equal, equal_start = "".join(old_tokens[i1:i2]), j1
+            continue
+        old_span = "".join(old_tokens[i1:i2])
+        move_cursor(cursor, len(equal) + len(old_span), True)
+        if cursor.getString() != equal + old_span:
+            # the range holds something that isn't one character per letter (e.g. a field),
+            # so the offsets are off from here on: replace the rest of the range instead
+            cursor.collapseToStart()
+            cursor.gotoRange(text_range.getEnd(), True)
+            cursor.setString("")
+            text.insertString(cursor, "".join(new_tokens[equal_start if equal else j1:]), False)
+            return replaced + 1
+        cursor.collapseToEnd()
+        if old_span:
+            move_cursor(cursor, len(old_span), True, forward=False)
+            cursor.setString("")
+        if j2 > j1:
+            # inserting leaves the cursor behind the new text, where the next unchanged run starts
+            text.insertString(cursor, "".join(new_tokens[j1:j2]), False)
+        replaced += 1
+        equal = ""
+    return replaced
+
+
+class RangeWriter:
+    """ Appends streamed text to the end of a Writer text range.
+        write() may be called from the worker thread; the pending text is coalesced
+        and inserted through a text cursor from the main thread.
+    """
+    def __init__(self, ctx, text_range, replace=False, metrics=None, undo=None):
+        self.ctx = ctx
+        self.text_range = text_range
+        self.replace = replace
+        # all flushes of a job join one undo action, see UndoGroup
+        self.undo = undo
+        # inserts are timed as document write-back when a JobMetrics is given
+        self.timed = metrics.timed if metrics else (lambda func: func)
+        self.flush = self.timed(self._flush)
+        self.text = text_range.getText()
+        self.cursor = None
+        self.pending = []
+        self.scheduled = False
+        self.lock = threading.Lock()
+
+    def write(self, delta):
+        with self.lock:
+            self.pending.append(delta)
+            if self.scheduled:
+                return
+            self.scheduled = True
+        run_on_main_thread(self.ctx, self.flush)
+
+    def _flush(self):
+        with self.lock:
+            new_text = "".join(self.pending)
+            self.pending = []
+            self.scheduled = False
+        if not new_text:
+            return
+        if self.undo is not None:
+            self.undo.run(lambda: self._write(new_text))
+        else:
+            self._write(new_text)
+
+    def _write(self, new_text):
+        if self.cursor is None and self.replace:
+            # only remove the original once the model actually produced something
+            self.text_range.setString("")
+        self._insert(new_text)
+
+    def _insert(self, new_text):
+        if self.cursor is None:
+            self.cursor = self.text.createTextCursorByRange(self.text_range.getEnd())
+        self.text.insertString(self.cursor, new_text, False)
+
+    def edit(self, original, new_text):
+        # applies the whole result at once as an edit of original, see apply_text_edit
+        def run():
+            if self.undo is not None:
+                self.undo.run(lambda: apply_text_edit(self.text_range, original, new_text))
+            else:
+                apply_text_edit(self.text_range, original, new_text)
+        run_on_main_thread(self.ctx, self.timed(run))
+
+
+class PooledResponse:
+    # Wraps an http.client response; closing it hands the connection back to the pool
+    # if the body was read to the end, otherwise the connection is dropped.
+    def __init__(self, pool, key, conn, response):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+
+    def read(self):
+        return self.response.read()
+
+    def drain(self):
+        import http.client
+        # reads what is left after the end of a stream (e.g. the last empty chunk) so the
+        # connection can go back to the pool
+        try:
+            self.response.read()
+        except (http.client.HTTPException, OSError):
+            pass
+
+    def __iter__(self):
+        while True:
+            line = self.response.readline()
+            if not line:
+                break
+            yield line
+
+    def close(self):
+        if self.conn is None:
+            return
+        conn, self.conn = self.conn, None
+        # isclosed() means the whole body was consumed, sock is None if the server asked to close
+        if self.response.isclosed() and conn.sock is not None:
+            self.pool.release(self.key, conn)
+        else:
+            self.response.close()
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ConnectionPool:
+    """ Keeps idle keep-alive connections to each backend (scheme, host, port), so
+        consecutive requests skip the TCP/TLS handshake.
+        A reused connection that turns out to have been closed by the server is
+        replaced by a fresh one and the request is sent again.
+    """
+    def __init__(self, max_idle=16):
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.stats = {"requests": 0, "reused": 0, "connections": 0, "reconnects": 0}
+
+    def _acquire(self, key, connect_timeout):
+        import http.client
+        with self.lock:
+            connections = self.idle.get(key)
+            if connections:
+                self.stats["reused"] += 1
+                return connections.pop(), True
+            self.stats["connections"] += 1
+        scheme, host, port = key
+        # without a timeout the connection blocks until the server answers
+        kwargs = {"timeout": connect_timeout} if connect_timeout else {}
+        if scheme == "https":
+            import ssl
+            return http.client.HTTPSConnection(host, port, context=ssl.create_default_context(), **kwargs), False
+        return http.client.HTTPConnection(host, port, **kwargs), False
+
+    def release(self, key, conn):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append(conn)
+                return
+        conn.close()
+
+    def post(self, url, body, headers, connect_timeout=None, read_timeout=None):
+        """ POSTs body to url and returns a PooledResponse, raising urllib.error.HTTPError
+            for error statuses like urllib.request.urlopen does.
+            @param connect_timeout seconds to wait for a new connection, None waits forever
+            @param read_timeout seconds to wait for each read from the server, None waits forever
+        """
+        import http.client
+        import urllib.error
+        import urllib.parse
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        with self.lock:
+            self.stats["requests"] += 1
+        connect_seconds = 0.0
+        while True:
+            conn, reused = self._acquire(key, connect_timeout)
+            try:
+                if not reused:
+                    started = time.perf_counter()
+                    conn.connect()
+                    connect_seconds += time.perf_counter() - started
+                conn.sock.settimeout(read_timeout or None)
+                conn.request("POST", path, body=body, headers=headers)
+                response = conn.getresponse()
+            except (ConnectionError, http.client.BadStatusLine):
+                conn.close()
+                if not reused:
+                    raise
+                # the server dropped the idle connection, try again on a new one
+                with self.lock:
+                    self.stats["reconnects"] += 1
+                continue
+            except Exception:
+                conn.close()
+                raise
+            break
+
+        pooled = PooledResponse(self, key, conn, response)
+        pooled.reused = reused
+        pooled.connect_seconds = connect_seconds
+        if response.status >= 400:
+            error_body = response.read()
+            pooled.close()
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(error_body))
+        return pooled
+
+    def describe_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        return "connection pool: {requests} requests, {reused} on reused connections, {connections} new connections, {reconnects} reconnects".format(**stats)
+
+
+_http_pool = ConnectionPool()
+
+
+def parse_endpoints(value):
+    # the endpoint setting is one URL, a list of URLs or a comma separated string of them
+    if isinstance(value, str):
+        value = value.split(",")
+    return [endpoint.strip().rstrip("/") for endpoint in value if endpoint.strip()]
+
+
+class EndpointScheduler:
+    """ Spreads requests over several backend servers.
+        With the "least_outstanding" policy the server with the fewest requests in
+        flight is picked, with "latency" the one with the lowest smoothed response time
+        weighted by its requests in flight. A server that fails to connect or times out
+        is skipped for a while (longer after each consecutive failure), unless every
+        server is down.
+    """
+    LATENCY_SMOOTHING = 0.3
+    MAX_DOWN_SECONDS = 60.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.servers = {}
+        self.turn = 0
+
+    def _server(self, endpoint):
+        server = self.servers.get(endpoint)
+        if server is None:
+            server = self.servers[endpoint] = {"outstanding": 0, "latency": None, "failures": 0, "down_until": 0.0}
+        return server
+
+    def acquire(self, endpoints, policy="least_outstanding", exclude=()):
+        """ Picks one of endpoints and counts a request in flight on it, the caller must
+            hand it back with release() or failed().
+        """
+        now = time.monotonic()
+        with self.lock:
+            candidates = [endpoint for endpoint in endpoints if endpoint not in exclude] or list(endpoints)
+            up = [endpoint for endpoint in candidates if self._server(endpoint)["down_until"] <= now]
+            if not up:
+                # everything is marked down, try the one that comes back first
+                up = [min(candidates, key=lambda endpoint: self.servers[endpoint]["down_until"])]
+
+            # rotate the start so ties don't always go to the first server
+            self.turn += 1
+            start = self.turn % len(up)
+            up = up[start:] + up[:start]
+
+            def load(endpoint):
+                server = self.servers[endpoint]
+                if policy == "latency":
+                    # servers without a measurement yet are tried first
+                    return (server["latency"] or 0.0) * (server["outstanding"] + 1)
+                return server["outstanding"]
+            endpoint = min(up, key=load)
+            self.servers[endpoint]["outstanding"] += 1
+            return endpoint
+
+    def responded(self, endpoint, seconds):
+        with self.lock:
+            server = self._server(endpoint)
+            server["latency"] = seconds if server["latency"] is None else (
+                self.LATENCY_SMOOTHING * seconds + (1 - self.LATENCY_SMOOTHING) * server["latency"])
+            server["failures"] = 0
+            server["down_until"] = 0.0
+
+    def release(self, endpoint):
+        with self.lock:
+            server = self._server(endpoint)
+            server["outstanding"] = max(0, server["outstanding"] - 1)
+
+    def failed(self, endpoint):
+        with self.lock:
+            server = self._server(endpoint)
+            server["outstanding"] = max(0, server["outstanding"] - 1)
+            server["failures"] += 1
+            server["down_until"] = time.monotonic() + min(self.MAX_DOWN_SECONDS, 2.0 ** server["failures"])
+
+    def describe(self):
+        with self.lock:
+            return ", ".join("{}: {} in flight, {}, {} failures".format(
+                endpoint, server["outstanding"],
+                "no latency yet" if server["latency"] is None else str(int(server["latency"] * 1000)) + " ms",
+                server["failures"]) for endpoint, server in self.servers.items())
+
+
+_scheduler = EndpointScheduler()
+
+
+def trim_start(text, max_chars):
+    # keep the last max_chars characters, without starting in the middle of a word
+    if len(text) <= max_chars:
+        return text
+    text = text[len(text) - max_chars:]
+    space = text.find(" ")
+    if 0 <= space < 20:
+        text = text[space + 1:]
+    return text
+
+
+def changed_blocks(cells, block_rows):
+    """ Covers exactly the (row, column) positions in cells with rectangles, returned as
+        (first_row, first_column, last_row, last_column): runs of consecutive rows in one column,
+        split at every block_rows rows, joined with the same run of the next column.
+    """
+    columns = {}
+    for r, c in cells:
+        columns.setdefault(c, set()).add(r)
+    blocks = []
+    # (first_row, last_row) -> first column of a rectangle that ends in the previous column
+    open_runs = {}
+    previous_column = None
+    for c in sorted(columns):
+        rows = sorted(columns[c])
+        runs = []
+        first = rows[0]
+        for previous, r in zip(rows, rows[1:]):
+            if r != previous + 1 or r // block_rows != previous // block_rows:
+                runs.append((first, previous))
+                first = r
+        runs.append((first, rows[-1]))
+        adjacent = previous_column == c - 1
+        continued = {}
+        for run in runs:
+            continued[run] = open_runs.pop(run) if adjacent and run in open_runs else c
+        blocks.extend((first_row, first_column, last_row, previous_column) for (first_row, last_row), first_column in open_runs.items())
+        open_runs = continued
+        previous_column = c
+    blocks.extend((first_row, first_column, last_row, previous_column) for (first_row, last_row), first_column in open_runs.items())
+    return blocks
+
+
+def get_user_config_dir(ctx):
+    # The UserConfig path doesn't change while the office runs, so PathSettings is only asked once
+    global _user_config_dir
+    if _user_config_dir is None:
+        path_settings = ctx.getServiceManager().createInstanceWithContext('com.sun.star.util.PathSettings', ctx)
+        user_config_path = getattr(path_settings, "UserConfig")
+
+        if user_config_path.startswith('file://'):
+            user_config_path = str(uno.fileUrlToSystemPath(user_config_path))
+        _user_config_dir = user_config_path
+    return _user_config_dir
+
+_user_config_dir = None
+
+
+class ConfigStore:
+    """ In-memory copy of localwriter.json.
+        The parsed file is cached and only re-read when its modification time or size
+        changes, so the file can still be edited by hand while the office is running.
+        Updates are written through atomically (temporary file + rename).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {}
+        self.signature = None
+
+    def _signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _refresh(self):
+        signature = self._signature()
+        if signature == self.signature:
+            return
+        data = {}
+        if signature is not None:
+            try:
+                with open(self.path, 'r') as file:
+                    data = json.load(file)
+            except (IOError, json.JSONDecodeError):
+                data = {}
+        self.data = data if isinstance(data, dict) else {}
+        self.signature = signature
+
+    def get(self, key, default):
+        with self.lock:
+            self._refresh()
+            return self.data.get(key, default)
+
+    def update(self, values):
+        with self.lock:
+            self._refresh()
+            config_data = dict(self.data)
+            config_data.update(values)
+
+            # Write the updated configuration next to the file and swap it in, so a crash
+            # or a concurrent reader never sees a half written localwriter.json
+            import tempfile
+            temp_path = None
+            try:
+                fd, temp_path = tempfile.mkstemp(prefix=".localwriter-", suffix=".json", dir=os.path.dirname(self.path))
+                with os.fdopen(fd, 'w') as file:
+                    json.dump(config_data, file, indent=4)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(temp_path, self.path)
+            except (IOError, OSError) as e:
+                # Handle potential IO errors (optional)
+                print(f"Error writing to {self.path}: {e}")
+                if temp_path is not None and os.path.exists(temp_path):
+                    os.remove(temp_path)
+                return
+
+            self.data = config_data
+            self.signature = self._signature()
+
+
+def get_config_store(ctx):
+    global _config_store
+    if _config_store is None:
+        _config_store = ConfigStore(os.path.join(get_user_config_dir(ctx), "localwriter.json"))
+    return _config_store
+
+_config_store = None
+
+
+# get_config adds the time it spends to this thread local counter, see RequestMetrics
+_config_timer = threading.local()
+
+
+class RequestMetrics:
+    """ Timings of one backend request, written as one JSON line to the metrics log:
+        config_ms and prompt_ms (building the request), connect_ms, ttft_ms (time to
+        first streamed token), generation_ms (request sent to last byte), plus token
+        counts from the response's usage information. tokens_per_second is the decode
+        rate after the first streamed token (reasoning included), e2e_tokens_per_second
+        counts from sending the request, so it includes prefill.
+    """
+    def __init__(self, kind):
+        self.record = {"type": "request", "kind": kind, "time": round(time.time(), 3)}
+        self.started = time.perf_counter()
+        self.sent_at = None
+        self.generating_at = None
+        _config_timer.seconds = 0.0
+
+    def built(self):
+        # called once the request is built, on the thread that built it
+        config_seconds = getattr(_config_timer, "seconds", 0.0)
+        self.record["config_ms"] = round(config_seconds * 1000, 2)
+        self.record["prompt_ms"] = round((time.perf_counter() - self.started - config_seconds) * 1000, 2)
+
+    def sending(self):
+        self.sent_at = time.perf_counter()
+        self.generating_at = None
+
+    def connected(self, response):
+        self.record["connect_ms"] = round(response.connect_seconds * 1000, 2)
+        self.record["reused_connection"] = response.reused
+
+    def generating(self):
+        # the first streamed token of any kind, hidden reasoning included
+        if self.generating_at is None:
+            self.generating_at = time.perf_counter()
+
+    def first_token(self):
+        if "ttft_ms" not in self.record and self.sent_at is not None:
+            self.record["ttft_ms"] = round((time.perf_counter() - self.sent_at) * 1000, 2)
+
+    def finished(self, ctx, endpoint, model, usage=None, cached=False):
+        record = self.record
+        record["endpoint"] = endpoint
+        record["model"] = model
+        record["cached"] = cached
+        if self.sent_at is not None:
+            now = time.perf_counter()
+            generation_seconds = now - self.sent_at
+            record["generation_ms"] = round(generation_seconds * 1000, 2)
+            if usage and usage.get("completion_tokens"):
+                record["prompt_tokens"] = usage.get("prompt_tokens")
+                record["completion_tokens"] = usage["completion_tokens"]
+                if generation_seconds > 0:
+                    record["e2e_tokens_per_second"] = round(usage["completion_tokens"] / generation_seconds, 2)
+                # the first token is not part of the decode time
+                if self.generating_at is not None and usage["completion_tokens"] > 1 and now > self.generating_at:
+                    record["tokens_per_second"] = round((usage["completion_tokens"] - 1) / (now - self.generating_at), 2)
+        get_metrics_log(ctx).write(record)
+
+
+class JobMetrics:
+    """ Timings of a whole Extend/Edit Selection run: the time spent writing results back
+        into the document on the main thread, and the total time until the last write.
+    """
+    def __init__(self, kind):
+        self.record = {"type": "job", "kind": kind, "time": round(time.time(), 3), "requests": 0}
+        self.started = time.perf_counter()
+        self.writeback_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def timed(self, func):
+        # wraps a main thread document update so its duration counts as write-back
+        def wrapper(*args):
+            started = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                with self.lock:
+                    self.writeback_seconds += time.perf_counter() - started
+        return wrapper
+
+    def finish(self, ctx, requests, saved=0):
+        """ @param saved requests that were not needed because identical cells were only sent once"""
+        self.record["requests"] = requests
+        if saved:
+            self.record["requests_saved"] = saved
+
+        def commit():
+            self.record["writeback_ms"] = round(self.writeback_seconds * 1000, 2)
+            self.record["total_ms"] = round((time.perf_counter() - self.started) * 1000, 2)
+            get_metrics_log(ctx).write(self.record)
+        # queued behind the document updates, so it runs once they are all done
+        run_on_main_thread(ctx, commit)
+
+
+class MetricsLog:
+    """ JSON lines log of RequestMetrics/JobMetrics records, rotated at 1 MB."""
+    MAX_BYTES = 1024 * 1024
+    BACKUP_COUNT = 3
+
+    def __init__(self, path):
+        import logging
+        import logging.handlers
+        self.path = path
+        self.logger = logging.getLogger("localwriter.metrics")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        if not self.logger.handlers:
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes=self.MAX_BYTES, backupCount=self.BACKUP_COUNT, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.logger.addHandler(handler)
+
+    def write(self, record):
+        try:
+            self.logger.info(json.dumps(record))
+        except Exception as e:
+            log_to_file("could not write metrics: " + str(e))
+
+    def records(self):
+        # oldest rotated file first
+        paths = [self.path + "." + str(i) for i in range(self.BACKUP_COUNT, 0, -1)] + [self.path]
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+
+
+def get_metrics_log(ctx):
+    global _metrics_log
+    # requests finishing on several pool threads at once must not each add a log handler
+    with _metrics_log_lock:
+        if _metrics_log is None:
+            _metrics_log = MetricsLog(os.path.join(get_user_config_dir(ctx), "localwriter_metrics.jsonl"))
+    return _metrics_log
+
+_metrics_log = None
+_metrics_log_lock = threading.Lock()
+
+
+def percentile(values, p):
+    # nearest rank percentile of a non-empty list
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def format_statistics(records):
+    """ Summarizes metrics records as p50/p95 latencies per model and endpoint."""
+    groups = collections.OrderedDict()
+    writeback = []
+    saved = 0
+    for record in records:
+        if record.get("type") == "request" and not record.get("cached"):
+            groups.setdefault((record.get("model") or "(default model)", record.get("endpoint", "")), []).append(record)
+        elif record.get("type") == "job" and "writeback_ms" in record:
+            writeback.append(record["writeback_ms"])
+            saved += record.get("requests_saved", 0)
+    if not groups:
+        return "No requests recorded yet."
+
+    def summary(rows, field, unit="ms"):
+        values = [row[field] for row in rows if row.get(field) is not None]
+        if not values:
+            return "n/a"
+        return "p50 {:.0f} / p95 {:.0f} {}".format(percentile(values, 50), percentile(values, 95), unit)
+
+    lines = []
+    for (model, endpoint), rows in groups.items():
+        lines.append("{} @ {} ({} requests)".format(model, endpoint, len(rows)))
+        lines.append("    time to first token: " + summary(rows, "ttft_ms"))
+        lines.append("    generation: " + summary(rows, "generation_ms"))
+        lines.append("    connect: " + summary(rows, "connect_ms"))
+        lines.append("    prompt build: " + summary(rows, "prompt_ms"))
+        lines.append("    tokens/s (decode): " + summary(rows, "tokens_per_second", "tok/s"))
+        lines.append("    tokens/s (end to end): " + summary(rows, "e2e_tokens_per_second", "tok/s"))
+    if writeback:
+        lines.append("document write-back per job: p50 {:.0f} / p95 {:.0f} ms".format(percentile(writeback, 50), percentile(writeback, 95)))
+    if saved:
+        lines.append("requests saved by sending identical cells once: {}".format(saved))
+    return "\n".join(lines)
+
+
+class CompletionRequest:
+    # A backend independent request: path is relative to the configured endpoint,
+    # data is the JSON payload built by the adapter.
+    def __init__(self, adapter, path, data, conversation=None):
+        self.adapter = adapter
+        self.path = path
+        self.data = data
+        # (model, system, prompt) of the logical request, used by adapters that keep server side state
+        self.conversation = conversation
+        # stop sequences that are also enforced on the client, see StopSequenceFilter
+        self.stop = []
+        self.metrics = None
+        # ThinkingIndicator to report reasoning to while streaming
+        self.indicator = None
+        # set on the second attempt after the model used up thinking_max_tokens
+        self.nudged = False
+
+    def nudge(self, data):
+        # a copy of the request with other data, for the attempt that skips the reasoning
+        request = CompletionRequest(self.adapter, self.path, data, self.conversation)
+        request.stop = self.stop
+        request.metrics = self.metrics
+        request.indicator = self.indicator
+        request.nudged = True
+        return request
+
+
+class StopSequenceFilter:
+    """ Cuts streamed text at the first stop sequence. Only the tail of the text that
+        could still turn into a stop sequence is held back until the next delta.
+    """
+    def __init__(self, stops):
+        self.stops = [stop for stop in stops if stop]
+        self.buffer = ""
+        self.stopped = False
+
+    def feed(self, delta):
+        if self.stopped:
+            return ""
+        self.buffer += delta
+        index = apply_stop_index(self.buffer, self.stops)
+        if index is not None:
+            self.stopped = True
+            # the line break in front of an end marker isn't part of the text either
+            text, self.buffer = self.buffer[:index].rstrip("\n"), ""
+            return text
+        cut = len(self.buffer) - partial_tail(self.buffer, self.stops)
+        # line breaks are held back too, in case a stop sequence follows them
+        while cut > 0 and self.buffer[cut - 1] == "\n":
+            cut -= 1
+        text, self.buffer = self.buffer[:cut], self.buffer[cut:]
+        return text
+
+    def flush(self):
+        text, self.buffer = self.buffer, ""
+        return text
+
+
+def partial_tail(text, markers):
+    # length of the longest end of text that could still grow into one of markers
+    for length in range(min(len(text), max([len(marker) for marker in markers] or [1]) - 1), 0, -1):
+        if any(marker.startswith(text[-length:]) for marker in markers):
+            return length
+    return 0
+
+
+def apply_stop_index(text, stops):
+    # position of the earliest stop sequence in text, or None
+    indexes = [text.find(stop) for stop in stops if stop and stop in text]
+    return min(indexes) if indexes else None
+
+
+def apply_stop(text, stops):
+    index = apply_stop_index(text, stops)
+    return text if index is None else text[:index].rstrip("\n")
+
+
+# (opening, closing) tags reasoning models wrap their hidden chain of thought in
+REASONING_TAGS = (("<think>", "</think>"), ("<thinking>", "</thinking>"))
+
+
+class ReasoningFilter:
+    """ Removes reasoning blocks such as <think>...</think> from streamed text. Like
+        StopSequenceFilter, only the tail that could still turn into a tag is held back.
+        thinking tells whether the model is reasoning right now, thought counts the
+        characters of reasoning so far, including reasoning a server sends in its own field.
+    """
+    def __init__(self):
+        self.buffer = ""
+        # closing tag of the block the text is in, None outside of reasoning
+        self.close = None
+        self.thinking = False
+        self.thought = 0
+        # the answer usually starts on a new line after a block
+        self.after_block = False
+
+    def feed(self, delta):
+        self.buffer += delta
+        if self.after_block:
+            self.buffer = self.buffer.lstrip("\n")
+            self.after_block = self.buffer == ""
+        visible = []
+        while True:
+            if self.close is None:
+                found = [(self.buffer.find(opening), opening, closing) for opening, closing in REASONING_TAGS if opening in self.buffer]
+                if not found:
+                    break
+                index, opening, self.close = min(found)
+                visible.append(self.buffer[:index])
+                self.buffer = self.buffer[index + len(opening):]
+            else:
+                index = self.buffer.find(self.close)
+                if index < 0:
+                    break
+                self.thought += index
+                self.buffer = self.buffer[index + len(self.close):].lstrip("\n")
+                self.after_block = self.buffer == ""
+                self.close = None
+        if self.close is None:
+            cut = len(self.buffer) - partial_tail(self.buffer, [opening for opening, closing in REASONING_TAGS])
+            visible.append(self.buffer[:cut])
+        else:
+            cut = len(self.buffer) - partial_tail(self.buffer, [self.close])
+            self.thought += cut
+        self.buffer = self.buffer[cut:]
+        self.thinking = self.close is not None
+        return "".join(visible)
+
+    def think(self, reasoning):
+        # reasoning the server keeps apart from the text (reasoning_content, Ollama's thinking)
+        self.thought += len(reasoning)
+        self.thinking = True
+
+    def flush(self):
+        # a block that was never closed is dropped
+        text, self.buffer = ("" if self.close else self.buffer), ""
+        self.thinking = False
+        return text
+
+
+def strip_reasoning(text):
+    reasoning = ReasoningFilter()
+    return reasoning.feed(text) + reasoning.flush()
+
+
+class ThinkingIndicator:
+    """ Shows "thinking..." in the status bar of the document while any request of a
+        job is inside a reasoning block. update() may be called from any thread.
+    """
+    def __init__(self, ctx, document, title):
+        self.ctx = ctx
+        self.document = document
+        self.title = title
+        self.lock = threading.Lock()
+        self.thinking = set()
+        # only used on the main thread
+        self.indicator = None
+
+    def update(self, request, thinking):
+        if self.document is None:
+            return
+        with self.lock:
+            before = bool(self.thinking)
+            if thinking:
+                self.thinking.add(id(request))
+            else:
+                self.thinking.discard(id(request))
+            # queued under the lock, so show and hide reach the main thread in order
+            if bool(self.thinking) != before:
+                run_on_main_thread(self.ctx, self._show if self.thinking else self._hide)
+
+    def _show(self):
+        try:
+            if self.indicator is None:
+                self.indicator = self.document.CurrentController.getFrame().createStatusIndicator()
+            self.indicator.start(self.title + ": thinking\u2026", 0)
+        except Exception as e:
+            log_to_file("could not show the thinking indicator: " + str(e))
+
+    def _hide(self):
+        if self.indicator is not None:
+            self.indicator.end()
+
+
+class ProgressIndicator:
+    """ Shows in the status bar of the document how much of the expected text has been
+        received, for results that are collected before they are applied. advance() may
+        be called from any thread, updates are coalesced like RangeWriter's writes.
+    """
+    def __init__(self, ctx, document, title, expected):
+        self.ctx = ctx
+        self.document = document
+        self.title = title
+        self.expected = max(1, expected)
+        self.lock = threading.Lock()
+        self.received = 0
+        self.scheduled = False
+        self.ended = False
+        # only used on the main thread
+        self.indicator = None
+
+    def advance(self, count):
+        if self.document is None:
+            return
+        with self.lock:
+            self.received += count
+            if self.scheduled:
+                return
+            self.scheduled = True
+        run_on_main_thread(self.ctx, self._update)
+
+    def end(self):
+        run_on_main_thread(self.ctx, self._end)
+
+    def _update(self):
+        with self.lock:
+            received = min(self.received, self.expected)
+            self.scheduled = False
+        if self.ended:
+            return
+        try:
+            if self.indicator is None:
+                self.indicator = self.document.CurrentController.getFrame().createStatusIndicator()
+                self.indicator.start(self.title + ": receiving\u2026", self.expected)
+            self.indicator.setValue(received)
+        except Exception as e:
+            log_to_file("could not show the progress indicator: " + str(e))
+
+    def _end(self):
+        self.ended = True
+        if self.indicator is not None:
+            self.indicator.end()
+
+
+# Edit Selection asks the model to finish with this marker, which is also the default stop sequence
+EDIT_END_MARKER = "END OF EDITED VERSION"
+# max_tokens for Edit Selection is this many times the token count of the original (plus edit_selection_max_new_tokens)
+EDIT_TOKEN_HEADROOM = 1.5
+
+# Chat style backends can't be asked to simply continue a prompt, so Extend Selection tells them to
+CONTINUE_INSTRUCTION = "Continue the text sent by the user. Reply only with the continuation, without repeating or commenting on the text."
+# Extend Selection needs at least this many tokens of context_max_tokens left for the text itself
+MIN_PROMPT_TOKENS = 32
+
+
+class CompletionsAdapter:
+    """ OpenAI compatible /v1/completions. There is no system role, so the system
+        prompt is folded into the prompt text.
+    """
+    path = "/v1/completions"
+    accept = "text/event-stream"
+
+    def build(self, system, prompt, params, continuation=False):
+        if system != "":
+            prompt = "SYSTEM PROMPT\n" + system + "\nEND SYSTEM PROMPT\n" + prompt
+        data = {'prompt': prompt}
+        data.update(self.openai_params(params))
+        return CompletionRequest(self, self.path, data)
+
+    def openai_params(self, params):
+        # keep_alive is Ollama specific, strict OpenAI compatible servers reject unknown fields
+        return {key: value for key, value in params.items() if key != "keep_alive"}
+
+    def stream_data(self, data):
+        # without include_usage, vLLM and OpenAI style servers leave the token counts out of streams
+        return dict(data, stream=True, stream_options={"include_usage": True})
+
+    def parse_response(self, response):
+        return response["choices"][0]["text"]
+
+    def parse_stream_line(self, line):
+        """ Returns (delta, chunk, done) for one line of the streamed response body."""
+        # blank lines separate events, lines starting with ":" are keep-alive comments
+        if not line.startswith("data:"):
+            return "", None, False
+        payload = line[len("data:"):].strip()
+        if payload == "[DONE]":
+            return "", None, True
+        chunk = json.loads(payload)
+        choices = chunk.get("choices") or []
+        return (self.chunk_text(choices[0]) if choices else "") or "", chunk, False
+
+    def chunk_text(self, choice):
+        return choice.get("text")
+
+    def stream_reasoning(self, chunk):
+        # reasoning that llama.cpp, vLLM and others stream apart from the text
+        choices = chunk.get("choices") or []
+        delta = (choices[0].get("delta") or {}) if choices else {}
+        return delta.get("reasoning_content") or delta.get("reasoning") or ""
+
+    def skip_thinking(self, request, received, closing):
+        """ Returns a request that makes the model answer without reasoning any further, or None.
+            The reasoning received so far is closed in the prompt, so the model continues with the answer.
+            @param closing the closing tag of the open reasoning block, None if it isn't in the text
+        """
+        if closing is None:
+            return None
+        return request.nudge(dict(request.data, prompt=request.data["prompt"] + received + "\n" + closing + "\n\n"))
+
+    def finished(self, request, text, final):
+        pass
+
+    def usage(self, final):
+        # token counts of a response (or of the last streamed chunk) if the server reported them
+        return (final or {}).get("usage")
+
+
+class ChatCompletionsAdapter(CompletionsAdapter):
+    """ OpenAI compatible /v1/chat/completions with a real system message."""
+    path = "/v1/chat/completions"
+
+    def build(self, system, prompt, params, continuation=False):
+        if continuation:
+            system = (system + "\n\n" if system != "" else "") + CONTINUE_INSTRUCTION
+        messages = []
+        if system != "":
+            messages.append({"role": "system", "content": system})
+        messages.append({"role": "user", "content": prompt})
+        data = {'messages': messages}
+        data.update(self.openai_params(params))
+        return CompletionRequest(self, self.path, data)
+
+    def parse_response(self, response):
+        return response["choices"][0]["message"]["content"]
+
+    def chunk_text(self, choice):
+        return (choice.get("delta") or {}).get("content")
+
+    def skip_thinking(self, request, received, closing):
+        # there is no way to prefill the answer, ask the chat template to leave reasoning out instead
+        return request.nudge(dict(request.data, chat_template_kwargs={"enable_thinking": False}))
+
+
+class OllamaAdapter(CompletionsAdapter):
+    """ Ollama's native /api/generate. Passes keep_alive so the model stays loaded, and
+        when a request continues the previous exchange (Extend Selection pressed again)
+        it sends the returned context instead of the whole text again.
+    """
+    path = "/api/generate"
+    accept = "application/x-ndjson"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (model, system, prompt + response, context) of the last finished generation
+        self.last = None
+
+    def options(self, params):
+        options = {"num_predict": params["max_tokens"]}
+        for key in ("temperature", "top_p", "seed", "stop"):
+            if key in params:
+                options[key] = params[key]
+        return options
+
+    def base_data(self, params):
+        data = {"model": params.get("model", ""), "stream": False, "options": self.options(params)}
+        if params.get("keep_alive") is not None:
+            data["keep_alive"] = params["keep_alive"]
+        return data
+
+    def build(self, system, prompt, params, continuation=False):
+        if continuation:
+            system = (system + "\n\n" if system != "" else "") + CONTINUE_INSTRUCTION
+        data = self.base_data(params)
+        data["prompt"] = prompt
+        data["system"] = system
+        conversation = (data["model"], system, prompt)
+        with self.lock:
+            last = self.last
+        if continuation and last is not None and last[:2] == conversation[:2] and prompt.startswith(last[2]):
+            # the context already holds the system prompt and everything up to here
+            rest = prompt[len(last[2]):]
+            data["prompt"] = rest if rest.strip() != "" else "Continue."
+            data["context"] = last[3]
+            del data["system"]
+        return CompletionRequest(self, self.path, data, conversation)
+
+    def parse_response(self, response):
+        return response["response"]
+
+    def stream_data(self, data):
+        return dict(data, stream=True)
+
+    def usage(self, final):
+        if not final or "eval_count" not in final:
+            return None
+        return {"prompt_tokens": final.get("prompt_eval_count"), "completion_tokens": final["eval_count"]}
+
+    def parse_stream_line(self, line):
+        # newline delimited JSON, the last object has done set and carries the context
+        if line == "":
+            return "", None, False
+        chunk = json.loads(line)
+        return self.chunk_text(chunk) or "", chunk, bool(chunk.get("done"))
+
+    def chunk_text(self, chunk):
+        return chunk.get("response")
+
+    def stream_reasoning(self, chunk):
+        return chunk.get("thinking") or ""
+
+    def skip_thinking(self, request, received, closing):
+        return request.nudge(dict(request.data, think=False))
+
+    def finished(self, request, text, final):
+        if request.conversation is not None and final and final.get("context"):
+            model, system, prompt = request.conversation
+            with self.lock:
+                self.last = (model, system, prompt + text, final["context"])
+
+
+class OllamaChatAdapter(OllamaAdapter):
+    """ Ollama's native /api/chat with a real system message."""
+    path = "/api/chat"
+
+    def build(self, system, prompt, params, continuation=False):
+        if continuation:
+            system = (system + "\n\n" if system != "" else "") + CONTINUE_INSTRUCTION
+        data = self.base_data(params)
+        data["messages"] = []
+        if system != "":
+            data["messages"].append({"role": "system", "content": system})
+        data["messages"].append({"role": "user", "content": prompt})
+        return CompletionRequest(self, self.path, data)
+
+    def parse_response(self, response):
+        return response["message"]["content"]
+
+    def chunk_text(self, chunk):
+        return (chunk.get("message") or {}).get("content")
+
+    def stream_reasoning(self, chunk):
+        return (chunk.get("message") or {}).get("thinking") or ""
+
+
+# api_type setting -> adapter, adapters are shared because Ollama keeps the last context
+_backend_adapters = {
+    "completions": CompletionsAdapter(),
+    "chat": ChatCompletionsAdapter(),
+    "ollama": OllamaAdapter(),
+    "ollama_chat": OllamaChatAdapter(),
+}
+
+
+def get_backend_adapter(api_type):
+    return _backend_adapters.get(api_type, _backend_adapters["completions"])
+
+
+class TokenEstimator:
+    """ Cheap token counts from a characters-per-token ratio.
+        The ratio starts at 4 and is calibrated once per (endpoint, model) in the
+        background, using the backend's tokenizer endpoint if it has one
+        (llama.cpp /tokenize or text-generation-webui /v1/internal/token-count).
+    """
+    DEFAULT_CHARS_PER_TOKEN = 4.0
+    # a short sample says little about the ratio, wait for a longer one
+    MIN_SAMPLE_CHARS = 200
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ratios = {}
+
+    def chars_per_token(self, key):
+        with self.lock:
+            return self.ratios.get(key) or self.DEFAULT_CHARS_PER_TOKEN
+
+    def estimate(self, text, key):
+        return int(math.ceil(len(text) / self.chars_per_token(key)))
+
+    def chars_for(self, tokens, key):
+        return max(0, int(tokens * self.chars_per_token(key)))
+
+    def calibrate_async(self, key, endpoint, sample):
+        if len(sample) < self.MIN_SAMPLE_CHARS:
+            return
+        with self.lock:
+            if key in self.ratios:
+                return
+            # None marks a calibration in progress
+            self.ratios[key] = None
+        threading.Thread(target=self._calibrate, args=(key, endpoint, sample[:4000]),
+                         name="localwriter-tokenize", daemon=True).start()
+
+    def _calibrate(self, key, endpoint, sample):
+        ratio = self.DEFAULT_CHARS_PER_TOKEN
+        for path, payload, count in (
+                ("/tokenize", {"content": sample}, lambda response: len(response["tokens"])),
+                ("/v1/internal/token-count", {"text": sample}, lambda response: response["length"])):
+            try:
+                with _http_pool.post(endpoint + path, json.dumps(payload).encode('utf-8'), {'Content-Type': 'application/json'},
+                                     connect_timeout=5, read_timeout=10) as response:
+                    tokens = count(json.loads(response.read().decode('utf-8')))
+            except Exception:
+                continue
+            if tokens > 0:
+                ratio = min(8.0, max(1.0, len(sample) / tokens))
+                break
+        log_to_file("token estimate for " + str(key) + ": " + str(round(ratio, 2)) + " characters per token")
+        with self.lock:
+            self.ratios[key] = ratio
+
+
+_token_estimator = TokenEstimator()
+
+
+class CompletionCache:
+    """ Completions keyed by a hash of the endpoint and the full request payload.
+        Recently used entries are kept in an in-memory LRU, and every entry is also
+        stored as a small JSON file in cache_dir. The least recently used files are
+        evicted once the directory grows past max_bytes.
+    """
+    def __init__(self, cache_dir, max_entries=256, max_bytes=50 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.memory = collections.OrderedDict()
+        self.disk_bytes = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(url, data):
+        import hashlib
+        payload = dict(data)
+        payload.pop("stream", None)
+        raw = json.dumps([url, payload], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as file:
+                text = json.load(file)["text"]
+            # touch the file so eviction sees it as recently used
+            os.utime(self._path(key))
+        except (IOError, OSError, ValueError, KeyError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+            self._remember(key, text)
+        return text
+
+    def put(self, key, text):
+        with self.lock:
+            self._remember(key, text)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            encoded = json.dumps({"text": text}, ensure_ascii=False).encode('utf-8')
+            try:
+                # an entry that is overwritten no longer counts
+                replaced = os.path.getsize(self._path(key))
+            except OSError:
+                replaced = 0
+            with open(self._path(key), 'wb') as file:
+                file.write(encoded)
+        except (IOError, OSError) as e:
+            log_to_file("could not write completion cache entry: " + str(e))
+            return
+        with self.lock:
+            if self.disk_bytes is not None:
+                self.disk_bytes += len(encoded) - replaced
+            self._evict()
+
+    def _remember(self, key, text):
+        self.memory[key] = text
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def _evict(self):
+        if self.disk_bytes is not None and self.disk_bytes <= self.max_bytes:
+            return
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".json"):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        self.disk_bytes = sum(size for _, size, _ in entries)
+        # drop the least recently used files until the cache is back under 90% of the limit
+        for _, size, name in sorted(entries):
+            if self.disk_bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            self.disk_bytes -= size
+            self.memory.pop(name[:-len(".json")], None)
+
+
+def get_completion_cache(ctx):
+    # Returns None when caching is off; the limits are re-read so settings apply without a restart
+    store = get_config_store(ctx)
+    if not store.get("cache_enabled", False):
+        return None
+    global _completion_cache
+    if _completion_cache is None:
+        _completion_cache = CompletionCache(os.path.join(get_user_config_dir(ctx), "localwriter_cache"))
+    _completion_cache.max_entries = max(1, int(store.get("cache_max_entries", 256)))
+    _completion_cache.max_bytes = max(0, int(store.get("cache_max_megabytes", 50))) * 1024 * 1024
+    return _completion_cache
+
+_completion_cache = None
+
+
+# HTTP statuses worth retrying: the server is overloaded, restarting or behind a proxy that timed out
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+def retry_delay(attempt, backoff, error=None):
+    # exponential backoff with full jitter, so parallel Calc requests don't retry in lockstep,
+    # but at least as long as the server asked for with Retry-After
+    import random
+    import urllib.error
+    delay = random.uniform(0, backoff * 2 ** attempt)
+    if isinstance(error, urllib.error.HTTPError) and error.headers is not None:
+        retry_after = error.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            delay = max(delay, min(30.0, float(retry_after)))
+    return delay
+
+
+def cell_name(column, row):
+    # A1 style name of a zero based column and row
+    name = ""
+    column += 1
+    while column:
+        column, remainder = divmod(column - 1, 26)
+        name = chr(ord("A") + remainder) + name
+    return name + str(row + 1)
+
+
+def parse_batch_response(text, count):
+    """ Parses the reply to a batched Calc prompt, a JSON object mapping "1".."count" to
+        the results (a plain list is accepted too).
+        Returns {index: text} with the zero based indexes of the entries that are valid.
+    """
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    if not starts:
+        return {}
+    start = min(starts)
+    end = text.rfind("}" if text[start] == "{" else "]")
+    try:
+        data = json.loads(text[start:end + 1])
+    except ValueError:
+        return {}
+    if isinstance(data, list):
+        data = {str(i + 1): value for i, value in enumerate(data)} if len(data) == count else {}
+    if not isinstance(data, dict):
+        return {}
+    results = {}
+    for i in range(count):
+        value = data.get(str(i + 1))
+        if isinstance(value, str):
+            results[i] = value
+    return results
+
+
+def is_disposed(document):
+    # a closed document's model raises (DisposedException) on every call
+    try:
+        document.getURL()
+        return False
+    except Exception:
+        return True
+
+
+class CalcRetryQueue:
+    """ Cells whose requests failed, kept per job so that Retry Failed Cells can run
+        them again without redoing the cells that succeeded.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = []
+
+    def add(self, name, cell_range, user_input, cells, document):
+        with self.lock:
+            self.entries.append((name, cell_range, user_input, cells, document))
+
+    def take(self, document):
+        """ Removes and returns the entries of document. Entries of documents that
+            were closed in the meantime are dropped. Call it on the main thread.
+        """
+        with self.lock:
+            entries = [entry for entry in self.entries if entry[4] == document]
+            self.entries = [entry for entry in self.entries if entry[4] != document and not is_disposed(entry[4])]
+        return entries
+
+    def put_back(self, entries):
+        with self.lock:
+            self.entries[:0] = entries
+
+
+_calc_retry_queue = CalcRetryQueue()
+
+
+class ExtendPrefetcher:
+    """ Speculative Extend Selection continuations.
+        After a continuation was inserted, the continuation of the grown text is generated
+        in the background; the next Extend Selection on exactly that text takes it instead
+        of sending a new request. Any other press discards the prefetched results, and
+        discarded prefetches that are still running are cancelled.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> (Future, GenerationJob whose cancel flag func checks)
+        self.pending = {}
+        self.running = 0
+
+    def start(self, key, func, max_outstanding):
+        """ Runs func(job) on a background thread unless key is already prefetched or
+            max_outstanding prefetches are still running (including discarded ones).
+            job is a GenerationJob that is cancelled when the prefetch is discarded.
+        """
+        import concurrent.futures
+        with self.lock:
+            if key in self.pending or self.running >= max_outstanding:
+                return False
+            future = concurrent.futures.Future()
+            job = GenerationJob("ExtendSelectionPrefetch", func)
+            self.pending[key] = (future, job)
+            self.running += 1
+
+        def run():
+            try:
+                future.set_result(func(job))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self.lock:
+                    self.running -= 1
+
+        threading.Thread(target=run, name="localwriter-prefetch", daemon=True).start()
+        return True
+
+    def take(self, key):
+        """ Returns the Future prefetched for key, or None, and discards all others."""
+        with self.lock:
+            entry = self.pending.pop(key, None)
+            discarded = list(self.pending.values())
+            self.pending.clear()
+        for other, job in discarded:
+            job.cancel()
+        if entry is None:
+            return None
+        future = entry[0]
+        if future.done() and future.exception() is not None:
+            # a failed prefetch is simply sent again
+            return None
+        return future
+
+    def clear(self):
+        # Cancel Generation stops the prefetches too
+        with self.lock:
+            discarded = list(self.pending.values())
+            self.pending.clear()
+        for future, job in discarded:
+            job.cancel()
+
+
+_prefetcher = ExtendPrefetcher()
+
+
+def parse_duration(value):
+    # Ollama keep_alive values: seconds as a number, or a string like "300", "90s", "30m", "1h";
+    # negative means forever. Returns seconds, None for forever.
+    text = str(value).strip().lower()
+    units = {"s": 1, "m": 60, "h": 3600}
+    factor = units.get(text[-1:], 1) if text else 1
+    if text[-1:] in units:
+        text = text[:-1]
+    try:
+        seconds = float(text) * factor
+    except ValueError:
+        return 300.0
+    return None if seconds < 0 else seconds
+
+
+class OllamaWarmer:
+    """ Keeps the Ollama model loaded while localwriter is in use.
+        A generate request without a prompt makes Ollama load the model and restart its
+        keep_alive timer without generating anything. After a warm-up, a background
+        thread repeats it at half the keep_alive time for as long as there was activity
+        (a command, or a document gaining focus) within the idle window.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_activity = time.monotonic()
+        self.last_warmed = {}
+        self.settings = None
+        self.thread = None
+        self.wake = threading.Event()
+
+    def touch(self):
+        with self.lock:
+            self.last_activity = time.monotonic()
+
+    def warm(self, settings, force=False):
+        """ Warms every endpoint in the background.
+            @param settings dict with endpoints, model, keep_alive, idle_seconds and read_timeout
+            @param force warm up even if it was done recently, e.g. after the settings changed
+        """
+        with self.lock:
+            self.settings = settings
+            if force:
+                self.last_warmed = {}
+            start_thread = self.thread is None or not self.thread.is_alive()
+            if start_thread:
+                self.thread = threading.Thread(target=self._run, name="localwriter-warmup", daemon=True)
+        if start_thread:
+            self.thread.start()
+        else:
+            # let the running thread look at the new settings right away
+            self.wake.set()
+
+    def _interval(self, settings):
+        keep_alive = parse_duration(settings["keep_alive"])
+        # a model that stays loaded forever only needs to be loaded once
+        return None if keep_alive is None else max(30.0, keep_alive / 2)
+
+    def _run(self):
+        while True:
+            self.wake.clear()
+            with self.lock:
+                settings = self.settings
+                if time.monotonic() - self.last_activity > settings["idle_seconds"]:
+                    # idle for too long, let Ollama unload the model
+                    self.thread = None
+                    return
+            interval = self._interval(settings)
+            for endpoint in settings["endpoints"]:
+                with self.lock:
+                    last = self.last_warmed.get(endpoint)
+                    due = last is None or (interval is not None and time.monotonic() - last >= interval)
+                    if due:
+                        self.last_warmed[endpoint] = time.monotonic()
+                if due:
+                    self._send(endpoint, settings)
+            with self.lock:
+                if interval is None:
+                    self.thread = None
+                    return
+            self.wake.wait(min(interval, 60.0))
+
+    def _send(self, endpoint, settings):
+        started = time.perf_counter()
+        body = json.dumps({"model": settings["model"], "prompt": "", "keep_alive": settings["keep_alive"], "stream": False}).encode('utf-8')
+        try:
+            with _http_pool.post(endpoint + "/api/generate", body, {'Content-Type': 'application/json'},
+                                 connect_timeout=10, read_timeout=settings["read_timeout"]) as response:
+                response.read()
+        except Exception as e:
+            log_to_file("warm-up of " + settings["model"] + " on " + endpoint + " failed: " + str(e))
+            return
+        log_to_file("warmed up " + settings["model"] + " on " + endpoint + " in " + str(round(time.perf_counter() - started, 2)) + " s")
+
+
+_warmer = OllamaWarmer()
+
+
+def retrieval_terms(text):
+    # lower case words, the terms BM25 matches on
+    import re
+    return re.findall(r"\w+", text.lower())
+
+
+def normalized(vector):
+    # scaled to length 1, so the dot product of two vectors is their cosine similarity
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+def with_excerpts(system, excerpts):
+    # retrieved paragraphs go into the system prompt, apart from the text the model works on
+    if not excerpts:
+        return system
+    return ((system + "\n\n") if system != "" else "") + \
+        "For reference, excerpts from elsewhere in the same document:\n" + excerpts
+
+
+class DocumentIndex:
+    """ Retrieval index over the paragraphs of one open document, so relevant text from
+        elsewhere in a long document can be added to a prompt. update() only processes
+        paragraphs that are new since the last call. Paragraphs are ranked with BM25, or
+        by embedding similarity once every paragraph has its embedding.
+    """
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # paragraph hash -> {"text", "terms": Counter, "length", "vector"}
+        self.paragraphs = {}
+        # term -> {paragraph hash: term frequency}
+        self.postings = {}
+        self.total_length = 0
+        # hashes of paragraphs without an embedding, and whether a thread is computing them
+        self.unembedded = set()
+        self.embedding = False
+
+    def update(self, texts):
+        """ Makes the index hold the non-empty paragraphs in texts, returns how many were added."""
+        import hashlib
+        current = {}
+        for text in texts:
+            text = text.strip()
+            if text:
+                current[hashlib.sha256(text.encode('utf-8')).hexdigest()] = text
+        added = 0
+        with self.lock:
+            for key in [key for key in self.paragraphs if key not in current]:
+                paragraph = self.paragraphs.pop(key)
+                for term in paragraph["terms"]:
+                    postings = self.postings[term]
+                    del postings[key]
+                    if not postings:
+                        del self.postings[term]
+                self.total_length -= paragraph["length"]
+                self.unembedded.discard(key)
+            for key, text in current.items():
+                if key in self.paragraphs:
+                    continue
+                terms = collections.Counter(retrieval_terms(text))
+                length = sum(terms.values())
+                self.paragraphs[key] = {"text": text, "terms": terms, "length": length, "vector": None}
+                for term, count in terms.items():
+                    self.postings.setdefault(term, {})[key] = count
+                self.total_length += length
+                self.unembedded.add(key)
+                added += 1
+        return added
+
+    def bm25(self, query):
+        """ Returns [(score, text)] of the paragraphs that share terms with query, best first."""
+        with self.lock:
+            count = len(self.paragraphs)
+            if count == 0:
+                return []
+            average = self.total_length / count or 1.0
+            scores = collections.Counter()
+            for term in set(retrieval_terms(query)):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for key, frequency in postings.items():
+                    length = self.paragraphs[key]["length"]
+                    scores[key] += idf * frequency * (self.K1 + 1) / (frequency + self.K1 * (1 - self.B + self.B * length / average))
+            return [(score, self.paragraphs[key]["text"]) for key, score in scores.most_common()]
+
+    def nearest(self, vector):
+        """ Returns [(similarity, text)] of all paragraphs, best first, for a normalized
+            query embedding, or None while some paragraphs have no embedding yet.
+        """
+        with self.lock:
+            if self.unembedded or not self.paragraphs:
+                return None
+            ranked = [(sum(a * b for a, b in zip(vector, paragraph["vector"])), paragraph["text"])
+                      for paragraph in self.paragraphs.values()]
+        ranked.sort(key=lambda item: item[0], reverse=True)
+        return ranked
+
+
+def get_document_index(document):
+    # one index per open document, the least recently used ones are dropped
+    key = document.RuntimeUID
+    with _document_indexes_lock:
+        index = _document_indexes.pop(key, None) or DocumentIndex()
+        _document_indexes[key] = index
+        while len(_document_indexes) > 8:
+            _document_indexes.popitem(last=False)
+    return index
+
+_document_indexes = collections.OrderedDict()
+_document_indexes_lock = threading.Lock()
+
+
+def get_embedding_cache(ctx):
+    # paragraph embeddings on disk by a hash of the model and the text, see MainJob.embeddings
+    global _embedding_cache
+    if _embedding_cache is None:
+        _embedding_cache = CompletionCache(os.path.join(get_user_config_dir(ctx), "localwriter_embeddings"),
+                                           max_entries=4096, max_bytes=200 * 1024 * 1024)
+    return _embedding_cache
+
+_embedding_cache = None
+
+
+def named_values(values):
+    # sequence of com.sun.star.beans.NamedValue as passed to XJob.execute, as a dict
+    return {value.Name: value.Value for value in values or ()}
 
 
 # The MainJob is a UNO component derived from unohelper.Base class
 # and also the XJobExecutor, the implemented interface
-class MainJob(unohelper.Base, XJobExecutor):
+class MainJob(unohelper.Base, XJobExecutor, XJob):
     def __init__(self, ctx):
         self.ctx = ctx
+        self.triggered = None
+        # batch runs collect the errors of their jobs here instead of showing message boxes
+        self.errors = None
         # handling different situations (inside LibreOffice or other process)
         try:
             self.sm = ctx.getServiceManager()
@@ -41,73 +1904,1010 @@ class MainJob(unohelper.Base, XJobExecutor):
             self.document = XSCRIPTCONTEXT.getDocument()
         except NameError:
             self.sm = ctx.ServiceManager
-            self.desktop = self.ctx.getServiceManager().createInstanceWithContext(
-                "com.sun.star.frame.Desktop", self.ctx)
+            self.desktop = get_service(self.ctx, "com.sun.star.frame.Desktop")
     
 
     def get_config(self,key,default):
-  
-        name_file ="localwriter.json"
-        #path_settings = create_instance('com.sun.star.util.PathSettings')
-        
-        
-        path_settings = self.sm.createInstanceWithContext('com.sun.star.util.PathSettings', self.ctx)
-
-        user_config_path = getattr(path_settings, "UserConfig")
-
-        if user_config_path.startswith('file://'):
-            user_config_path = str(uno.fileUrlToSystemPath(user_config_path))
-        
-        # Ensure the path ends with the filename
-        config_file_path = os.path.join(user_config_path, name_file)
-
-        # Check if the file exists
-        if not os.path.exists(config_file_path):
-            return default
-
-        # Try to load the JSON content from the file
-        try:
-            with open(config_file_path, 'r') as file:
-                config_data = json.load(file)
-        except (IOError, json.JSONDecodeError):
-            return default
-
+        started = time.perf_counter()
         # Return the value corresponding to the key, or the default value if the key is not found
-        return config_data.get(key, default)
+        value = get_config_store(self.ctx).get(key, default)
+        _config_timer.seconds = getattr(_config_timer, "seconds", 0.0) + time.perf_counter() - started
+        return value
 
     def set_config(self, key, value):
-        name_file = "localwriter.json"
-        
-        path_settings = self.sm.createInstanceWithContext('com.sun.star.util.PathSettings', self.ctx)
-        user_config_path = getattr(path_settings, "UserConfig")
-
-        if user_config_path.startswith('file://'):
-            user_config_path = str(uno.fileUrlToSystemPath(user_config_path))
+        self.set_configs({key: value})
 
-        # Ensure the path ends with the filename
-        config_file_path = os.path.join(user_config_path, name_file)
+    def set_configs(self, values):
+        # Update several keys with a single write of localwriter.json
+        get_config_store(self.ctx).update(values)
 
-        # Load existing configuration if the file exists
-        if os.path.exists(config_file_path):
+    def cached_completion(self, request):
+        """ Returns (cache, key, text) where text is the cached completion or None.
+            cache is None if caching is disabled; with cache_bypass set the lookup is
+            skipped but fresh results are still stored.
+        """
+        cache = get_completion_cache(self.ctx)
+        if cache is None:
+            return None, None, None
+        key = cache.key(",".join(self.endpoints()) + request.path, request.data)
+        if self.get_config("cache_bypass", False):
+            return cache, key, None
+        return cache, key, cache.get(key)
+
+    def endpoints(self):
+        return parse_endpoints(self.get_config("endpoint", "http://127.0.0.1:5000")) or ["http://127.0.0.1:5000"]
+
+    def post_to_endpoint(self, request, body, headers):
+        """ Sends body to one of the configured endpoints, trying the next one when a
+            server can't be reached or times out. When every endpoint failed, or the
+            server answered with a transient error status, the request is retried up to
+            request_retries times after a jittered exponential backoff.
+            Returns (endpoint, response); the caller hands the endpoint back with
+            _scheduler.release() once the response is read.
+        """
+        import http.client
+        import urllib.error
+        retries = max(0, int(self.get_config("request_retries", 2)))
+        backoff = float(self.get_config("retry_backoff_seconds", 0.5))
+        attempt = 0
+        while True:
             try:
-                with open(config_file_path, 'r') as file:
-                    config_data = json.load(file)
-            except (IOError, json.JSONDecodeError):
-                config_data = {}
+                return self._post_with_failover(request, body, headers)
+            except urllib.error.HTTPError as e:
+                if e.code not in RETRY_STATUSES or attempt >= retries:
+                    raise
+                error = e
+            except (OSError, http.client.HTTPException) as e:
+                if attempt >= retries:
+                    raise
+                error = e
+            delay = retry_delay(attempt, backoff, error)
+            attempt += 1
+            log_to_file("request failed (" + str(error) + "), retry " + str(attempt) + " of " + str(retries) + " in " + str(round(delay, 2)) + " s")
+            time.sleep(delay)
+
+    def _post_with_failover(self, request, body, headers):
+        import http.client
+        import urllib.error
+        endpoints = self.endpoints()
+        policy = self.get_config("endpoint_policy", "least_outstanding")
+        connect_timeout = self.get_config("connect_timeout", 10)
+        read_timeout = self.get_config("read_timeout", 300)
+        tried = []
+        while True:
+            endpoint = _scheduler.acquire(endpoints, policy, tried)
+            started = time.perf_counter()
+            try:
+                response = _http_pool.post(endpoint + request.path, body, headers, connect_timeout, read_timeout)
+            except urllib.error.HTTPError:
+                # the server is up and answered, an error status is not a reason to switch
+                _scheduler.release(endpoint)
+                raise
+            except (OSError, http.client.HTTPException) as e:
+                _scheduler.failed(endpoint)
+                tried.append(endpoint)
+                if len(tried) >= len(endpoints):
+                    raise
+                log_to_file(endpoint + " failed (" + str(e) + "), retrying on another endpoint")
+                continue
+            except Exception:
+                _scheduler.release(endpoint)
+                raise
+            _scheduler.responded(endpoint, time.perf_counter() - started)
+            return endpoint, response
+
+    def completion(self, request):
+        """ Sends a blocking completion request and returns the generated text, without reasoning.
+            With thinking_max_tokens set, the response is streamed so the budget can be enforced.
+        """
+        if self.thinking_budget():
+            return "".join(self.stream_completion(request))
+        model = self.get_config("model", "")
+        cache, key, cached = self.cached_completion(request)
+        if cached is not None:
+            request.metrics.finished(self.ctx, ",".join(self.endpoints()), model, cached=True)
+            return cached
+
+        headers = {
+            'Content-Type': 'application/json'
+        }
+
+        # Convert data to JSON format
+        json_data = json.dumps(request.data).encode('utf-8')
+
+        # Send the request over a pooled keep-alive connection and read the response
+        request.metrics.sending()
+        endpoint, response = self.post_to_endpoint(request, json_data, headers)
+        try:
+            with response:
+                request.metrics.connected(response)
+                response_data = response.read()
+        finally:
+            _scheduler.release(endpoint)
+
+        # If needed, decode the response data
+        response = json.loads(response_data.decode('utf-8'))
+        text = apply_stop(strip_reasoning(request.adapter.parse_response(response)), request.stop)
+        request.adapter.finished(request, text, response)
+        request.metrics.finished(self.ctx, endpoint, model, request.adapter.usage(response))
+        if cache is not None:
+            cache.put(key, text)
+        return text
+
+    def thinking_budget(self):
+        # thinking_max_tokens in characters, 0 without a limit
+        tokens = int(self.get_config("thinking_max_tokens", 0))
+        return _token_estimator.chars_for(tokens, self.token_estimate_key()) if tokens > 0 else 0
+
+    def stream_completion(self, request):
+        """ Sends a completion request with stream enabled and yields the text
+            deltas as they arrive. Reasoning blocks are left out; when the model reasons for
+            longer than thinking_max_tokens, the request is either sent again without
+            reasoning (thinking_budget_action "nudge") or fails ("abort").
+        """
+        model = self.get_config("model", "")
+        cache, key, cached = self.cached_completion(request)
+        if cached is not None:
+            request.metrics.finished(self.ctx, ",".join(self.endpoints()), model, cached=True)
+            yield cached
+            return
+
+        adapter = request.adapter
+        headers = {
+            'Content-Type': 'application/json',
+            'Accept': adapter.accept
+        }
+        json_data = json.dumps(adapter.stream_data(request.data)).encode('utf-8')
+
+        received = []
+        # the unfiltered text, to close the reasoning in the prompt when nudging
+        raw = []
+        final = None
+        stop_filter = StopSequenceFilter(request.stop)
+        reasoning = ReasoningFilter()
+        budget = self.thinking_budget()
+        over_budget = False
+        showing = False
+        request.metrics.sending()
+        endpoint, response = self.post_to_endpoint(request, json_data, headers)
+        try:
+            with response:
+                request.metrics.connected(response)
+                for raw_line in response:
+                    delta, chunk, done = adapter.parse_stream_line(raw_line.decode('utf-8').strip())
+                    if chunk is not None:
+                        final = chunk
+                        thought = adapter.stream_reasoning(chunk)
+                        if thought:
+                            request.metrics.generating()
+                            reasoning.think(thought)
+                    if delta:
+                        request.metrics.generating()
+                        raw.append(delta)
+                    delta = stop_filter.feed(reasoning.feed(delta)) if delta else ""
+                    if request.indicator is not None and reasoning.thinking != showing:
+                        showing = reasoning.thinking
+                        request.indicator.update(request, showing)
+                    if delta:
+                        request.metrics.first_token()
+                        received.append(delta)
+                        yield delta
+                    if done:
+                        response.drain()
+                        break
+                    if stop_filter.stopped:
+                        # leaving the with block closes the connection, so the backend stops generating
+                        break
+                    if budget and reasoning.thought > budget:
+                        over_budget = True
+                        break
+        finally:
+            _scheduler.release(endpoint)
+            if showing:
+                request.indicator.update(request, False)
+        if over_budget:
+            nudged = None
+            # nudging starts the answer over, which only works while none of it was passed on
+            if not received and not request.nudged and self.get_config("thinking_budget_action", "nudge") == "nudge":
+                nudged = adapter.skip_thinking(request, "".join(raw), reasoning.close)
+            if nudged is None:
+                raise RuntimeError("the model was still thinking after thinking_max_tokens (" + str(self.get_config("thinking_max_tokens", 0)) + ")")
+            log_to_file("thinking budget used up, asking the model to answer right away")
+            yield from self.stream_completion(nudged)
+            return
+        rest = stop_filter.feed(reasoning.flush()) + stop_filter.flush()
+        if rest:
+            received.append(rest)
+            yield rest
+
+        # only reached when the stream ran to the end, cancelled generations are not cached
+        text = "".join(received)
+        adapter.finished(request, text, final)
+        request.metrics.finished(self.ctx, endpoint, model, adapter.usage(final))
+        if cache is not None:
+            cache.put(key, text)
+
+    def sampling_params(self, max_tokens):
+        params = {
+            'max_tokens': max_tokens,
+            'temperature': 1,
+            'top_p': 0.9,
+            'seed': 10
+        }
+
+        model = self.get_config("model", "")
+        if model != "":
+            params["model"] = model
+        keep_alive = self.get_config("ollama_keep_alive", "30m")
+        if keep_alive != "":
+            params["keep_alive"] = keep_alive
+        return params
+
+    def backend_adapter(self):
+        return get_backend_adapter(self.get_config("api_type", "completions"))
+
+    def extend_selection_request(self, text, metrics=None, excerpts=""):
+        """ Returns a CompletionRequest that continues text.
+            @param metrics RequestMetrics started before the prompt text was gathered, if any
+            @param excerpts relevant text from elsewhere in the document, see retrieve()
+        """
+        metrics = metrics or RequestMetrics("ExtendSelection")
+        system_prompt = with_excerpts(self.get_config("extend_selection_system_prompt", ""), excerpts)
+        params = self.sampling_params(self.get_config("extend_selection_max_tokens", 70))
+        request = self.backend_adapter().build(system_prompt, text, params, continuation=True)
+        request.metrics = metrics
+        metrics.built()
+        return request
+
+    def token_estimate_key(self):
+        # all endpoints are expected to serve the same model, the first one is asked for calibration
+        return (self.endpoints()[0], self.get_config("model", ""))
+
+    def retrieval_tokens(self):
+        # the part of the prompt set aside for retrieved excerpts
+        return max(0, int(self.get_config("retrieval_tokens", 512))) if self.get_config("retrieval", False) else 0
+
+    def document_index(self, document):
+        """ Returns the retrieval index of a Writer document, brought up to date with its text,
+            or None when retrieval is off. Reads the document, so call it on the main thread.
+        """
+        if document is None or not hasattr(document, "Text") or not self.get_config("retrieval", False):
+            return None
+        index = get_document_index(document)
+        # the whole text in one call, instead of one per paragraph
+        index.update(document.Text.getString().splitlines())
+        if self.get_config("retrieval_method", "bm25") == "embeddings":
+            self.embed_paragraphs(index)
+        return index
+
+    def embed_paragraphs(self, index):
+        # computes missing paragraph embeddings in the background, until then retrieve() uses BM25
+        with index.lock:
+            if index.embedding or not index.unembedded:
+                return
+            index.embedding = True
+
+        def run():
+            try:
+                while True:
+                    with index.lock:
+                        batch = [(key, index.paragraphs[key]["text"]) for key in list(index.unembedded)[:32]]
+                    if not batch:
+                        break
+                    vectors = self.embeddings([text for key, text in batch])
+                    with index.lock:
+                        for (key, text), vector in zip(batch, vectors):
+                            if key in index.paragraphs:
+                                index.paragraphs[key]["vector"] = vector
+                            index.unembedded.discard(key)
+            except Exception as e:
+                log_to_file("could not compute paragraph embeddings: " + str(e))
+            finally:
+                with index.lock:
+                    index.embedding = False
+        threading.Thread(target=run, name="localwriter-embeddings", daemon=True).start()
+
+    def embeddings(self, texts):
+        """ Returns normalized embeddings of texts from the /v1/embeddings endpoint.
+            They are cached on disk by a hash of the embedding model and the text.
+        """
+        import hashlib
+        model = self.get_config("embedding_model", "") or self.get_config("model", "")
+        cache = get_embedding_cache(self.ctx)
+        keys = [hashlib.sha256(json.dumps([model, text]).encode('utf-8')).hexdigest() for text in texts]
+        vectors = [cache.get(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if not missing:
+            return vectors
+        data = {"input": [texts[i] for i in missing]}
+        if model != "":
+            data["model"] = model
+        request = CompletionRequest(None, "/v1/embeddings", data)
+        endpoint, response = self.post_to_endpoint(request, json.dumps(data).encode('utf-8'), {'Content-Type': 'application/json'})
+        try:
+            with response:
+                response_data = response.read()
+        finally:
+            _scheduler.release(endpoint)
+        items = sorted(json.loads(response_data.decode('utf-8'))["data"], key=lambda item: item.get("index", 0))
+        for i, item in zip(missing, items):
+            vectors[i] = normalized(item["embedding"])
+            cache.put(keys[i], vectors[i])
+        return vectors
+
+    def retrieve(self, index, query, prompt_text):
+        """ Returns the paragraphs of the index most relevant to query, at most retrieval_top_k
+            of them within retrieval_tokens, leaving out those already in prompt_text.
+            Returns "" without an index. May send a request, so better not called on the main thread
+            when retrieval_method is "embeddings".
+        """
+        if index is None or query.strip() == "":
+            return ""
+        ranked = None
+        if self.get_config("retrieval_method", "bm25") == "embeddings":
+            try:
+                ranked = index.nearest(self.embeddings([query])[0])
+            except Exception as e:
+                log_to_file("embedding retrieval failed, using BM25: " + str(e))
+        if ranked is None:
+            ranked = index.bm25(query)
+        top_k = max(0, int(self.get_config("retrieval_top_k", 4)))
+        budget = _token_estimator.chars_for(self.retrieval_tokens(), self.token_estimate_key())
+        excerpts = []
+        for score, text in ranked:
+            if len(excerpts) >= top_k:
+                break
+            if score <= 0 or text in prompt_text or len(text) > budget:
+                continue
+            excerpts.append(text)
+            budget -= len(text) + 2
+        return "\n\n".join(excerpts)
+
+    def extend_selection_context(self, text_range):
+        """ Returns the prompt text for extending text_range: the selection plus as much
+            of the preceding paragraphs as fits into extend_selection_context_tokens,
+            all of it trimmed from the far end to fit the context_max_tokens window.
+            Raises ValueError if the rest of the prompt leaves less than MIN_PROMPT_TOKENS for it.
+        """
+        key = self.token_estimate_key()
+        selection_text = text_range.getString()
+        _token_estimator.calibrate_async(key, key[0], selection_text)
+
+        # leave room for the system prompt and the tokens that will be generated
+        window = (self.get_config("context_max_tokens", 4096)
+                  - self.get_config("extend_selection_max_tokens", 70)
+                  - _token_estimator.estimate(self.get_config("extend_selection_system_prompt", ""), key)
+                  - self.retrieval_tokens())
+        if window < MIN_PROMPT_TOKENS:
+            # trimming the selection to fit would send an empty or meaningless prompt
+            raise ValueError("context_max_tokens (" + str(self.get_config("context_max_tokens", 4096)) + ") leaves only " + str(max(0, window))
+                             + " tokens for the text after extend_selection_max_tokens, the system prompt and retrieval_tokens")
+        window_chars = _token_estimator.chars_for(window, key)
+        if len(selection_text) >= window_chars:
+            return trim_start(selection_text, window_chars)
+
+        context_chars = min(window_chars - len(selection_text),
+                            _token_estimator.chars_for(self.get_config("extend_selection_context_tokens", 1024), key))
+        if context_chars <= 0:
+            return selection_text
+
+        # walk back paragraph by paragraph from the start of the selection
+        cursor = text_range.getText().createTextCursorByRange(text_range.getStart())
+        cursor.gotoStartOfParagraph(True)
+        context = cursor.getString()
+        while len(context) < context_chars and cursor.gotoPreviousParagraph(True):
+            context = cursor.getString()
+        if len(context) > context_chars:
+            context = trim_start(context, context_chars)
+        return context + selection_text
+
+    def edit_selection_request(self, text, user_input, calc=False, excerpts=""):
+        """ Returns a CompletionRequest that rewrites text according to user_input.
+            @param excerpts relevant text from elsewhere in the document, see retrieve()
+        """
+        metrics = RequestMetrics("EditSelection")
+        if calc:
+            prompt =  "ORIGINAL VERSION:\n" + text + "\n Below is an edited version according to the following instructions. Don't waste time thinking, be as fast as you can. There are no comments in the edited version. The edited version is followed by " + EDIT_END_MARKER + ". USER INSTRUCTIONS: \n" + user_input + "\nEDITED VERSION:\n"
         else:
-            config_data = {}
+            prompt =  "ORIGINAL VERSION:\n" + text + "\n Below is an edited version according to the following instructions. There are no comments in the edited version. The edited version is followed by " + EDIT_END_MARKER + " and the end of the document. The original version will be edited as follows to create the edited versio:\n" + user_input + "\nEDITED VERSION:\n"
+
+        system_prompt = with_excerpts(self.get_config("edit_selection_system_prompt", ""), excerpts)
+        # budget from the token count of the original instead of its length in characters,
+        # with some headroom because edits (and translations in particular) can grow the text
+        key = self.token_estimate_key()
+        _token_estimator.calibrate_async(key, key[0], text)
+        max_tokens = int(_token_estimator.estimate(text, key) * EDIT_TOKEN_HEADROOM) + self.get_config("edit_selection_max_new_tokens", 0)
+        params = self.sampling_params(max(1, max_tokens))
+
+        stop = self.get_config("edit_selection_stop", [EDIT_END_MARKER, "\nORIGINAL VERSION:"])
+        if stop:
+            # OpenAI compatible servers accept at most four stop sequences, the rest are only enforced here
+            params["stop"] = stop[:4]
+        request = self.backend_adapter().build(system_prompt, prompt, params)
+        request.stop = stop
+        request.metrics = metrics
+        metrics.built()
+        return request
+
+    def prefetch_key(self, text):
+        import hashlib
+        # everything that goes into an Extend Selection request besides the text
+        settings = [text, self.get_config("extend_selection_system_prompt", ""), self.get_config("extend_selection_max_tokens", 70),
+                    self.get_config("model", ""), self.get_config("api_type", "completions"), self.endpoints()]
+        return hashlib.sha256(json.dumps(settings).encode('utf-8')).hexdigest()
+
+    def prefetch_extend_selection(self, text_range, end, document=None):
+        """ Starts generating the continuation of text_range grown up to end in the background,
+            if extend_selection_prefetch is enabled. Called on the main thread.
+        """
+        if not self.get_config("extend_selection_prefetch", False):
+            return
+        cursor = text_range.getText().createTextCursorByRange(text_range.getStart())
+        cursor.gotoRange(end, True)
+        context = self.extend_selection_context(cursor)
+        query = cursor.getString()
+        index = self.document_index(document)
+        max_outstanding = max(1, int(self.get_config("extend_selection_prefetch_max", 1)))
+        stream = self.get_config("stream", True)
+
+        def prefetch(job):
+            import concurrent.futures
+            request = self.extend_selection_request(context, RequestMetrics("ExtendSelectionPrefetch"), self.retrieve(index, query, context))
+            if not stream:
+                return self.completion(request)
+            received = []
+            deltas = self.stream_completion(request)
+            try:
+                for delta in deltas:
+                    if job.is_cancelled():
+                        raise concurrent.futures.CancelledError()
+                    received.append(delta)
+            finally:
+                # closing the generator drops the connection, which stops the backend
+                deltas.close()
+            return "".join(received)
+        _prefetcher.start(self.prefetch_key(context), prefetch, max_outstanding)
+
+    def extend_selection_targets(self, name, text_ranges, document=None, contexts=None):
+        """ Returns the (text_range, request) targets of submit_writer_job that extend text_ranges.
+            The prompt text is read here on the main thread, excerpts are retrieved on the worker.
+            @param contexts the prompt texts of the ranges if they were already read with extend_selection_context
+        """
+        index = self.document_index(document)
+        targets = []
+        for i, text_range in enumerate(text_ranges):
+            context = contexts[i] if contexts else self.extend_selection_context(text_range)
+            # the metrics start on the worker, where the request is built and the config timer runs
+            targets.append((text_range, lambda context=context, query=text_range.getString():
+                            self.extend_selection_request(context, RequestMetrics(name), self.retrieve(index, query, context))))
+        return targets
+
+    def edit_selection_targets(self, text_ranges, user_input, document=None):
+        """ Returns the (text_range, request) targets of submit_writer_job that edit text_ranges.
+            The text is read here on the main thread, excerpts are retrieved on the worker.
+        """
+        index = self.document_index(document)
+        return [(text_range, lambda text=text_range.getString():
+                 self.edit_selection_request(text, user_input, excerpts=self.retrieve(index, text + "\n" + user_input, text)))
+                for text_range in text_ranges]
+
+    def submit_writer_job(self, name, targets, replace=False, prefetched=None, document=None):
+        """ Runs the requests on the generation worker and streams each result into its text range.
+            targets holds one (text_range, request) pair per range of the selection; several
+            ranges are processed concurrently on edit_selection_concurrency threads per endpoint.
+            A request may also be a function returning it, called on the worker, e.g. to retrieve excerpts there.
+            With replace and edit_selection_diff, each result is collected, with its progress in the
+            status bar, and applied as a word level edit of the range once it is complete.
+            @param prefetched Future of a prefetched continuation to insert instead of sending the request of the only target
+            @param document the document of the ranges, all writes of the job become one undo action
+        """
+        import concurrent.futures
+        stream = self.get_config("stream", True)
+        concurrency = max(1, int(self.get_config("edit_selection_concurrency", 4))) * len(self.endpoints())
+        job_metrics = JobMetrics(name)
+        undo = UndoGroup(document, "localwriter: " + name)
+        writers = [RangeWriter(self.ctx, text_range, replace, job_metrics, undo) for text_range, request in targets]
+        # with edit_selection_diff, replacements are applied as word level edits once complete,
+        # which keeps the formatting, comments and bookmarks of the text that didn't change
+        diff = replace and self.get_config("edit_selection_diff", True)
+        originals = [text_range.getString() if diff else None for text_range, request in targets]
+        thinking = ThinkingIndicator(self.ctx, document, "localwriter: " + name)
+        # an edit is about as long as the original
+        progress = ProgressIndicator(self.ctx, document, "localwriter: " + name, sum(len(original) for original in originals)) if diff and stream else None
+        errors = []
+
+        def generate(job, writer, request, original):
+            # returns the number of characters written into the range
+            written = 0
+            received = []
+            try:
+                if callable(request):
+                    request = request()
+                if request is not None:
+                    request.indicator = thinking
+                if prefetched is not None:
+                    # the prefetch may still be running, wait for it unless cancelled
+                    while not concurrent.futures.wait([prefetched], timeout=0.1).done:
+                        if job.is_cancelled():
+                            raise concurrent.futures.CancelledError()
+                    new_text = prefetched.result()
+                    writer.write(new_text)
+                    written += len(new_text)
+                elif stream:
+                    deltas = self.stream_completion(request)
+                    try:
+                        for delta in deltas:
+                            if job.is_cancelled():
+                                break
+                            if original is not None:
+                                received.append(delta)
+                                progress.advance(len(delta))
+                                continue
+                            writer.write(delta)
+                            written += len(delta)
+                    finally:
+                        # closing the generator drops the connection, which stops the backend
+                        deltas.close()
+                    if received and not job.is_cancelled():
+                        new_text = "".join(received)
+                        writer.edit(original, new_text)
+                        written += len(new_text)
+                elif original is not None:
+                    new_text = self.completion(request)
+                    if new_text and not job.is_cancelled():
+                        writer.edit(original, new_text)
+                        written += len(new_text)
+                else:
+                    new_text = self.completion(request)
+                    if not job.is_cancelled():
+                        writer.write(new_text)
+                        written += len(new_text)
+            except concurrent.futures.CancelledError:
+                pass
+            except Exception as e:
+                # whatever was streamed before the error stays in the document
+                errors.append((str(e), written))
+            return written
 
-        # Update the configuration with the new key-value pair
-        config_data[key] = value
+        def work(job):
+            try:
+                if len(targets) == 1:
+                    written = [generate(job, writers[0], targets[0][1], originals[0])]
+                else:
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=min(concurrency, len(targets)), thread_name_prefix="localwriter-write") as pool:
+                        written = list(pool.map(lambda index: generate(job, writers[index], targets[index][1], originals[index]), range(len(targets))))
+            finally:
+                if progress is not None:
+                    progress.end()
+            if len(targets) == 1 and errors:
+                message, kept = errors[0]
+                self.report_errors(name + " failed", [message], "The " + str(kept) + " characters received before the error were kept." if kept else "")
+            elif errors:
+                self.report_errors(name + ": " + str(len(errors)) + " of " + str(len(targets)) + " ranges failed", [message for message, kept in errors],
+                                   "The other ranges were done, text received before an error was kept.")
+            elif len(targets) == 1 and name == "ExtendSelection" and written[0] and not job.is_cancelled():
+                text_range, writer = targets[0][0], writers[0]
+                # queued after the writer's flush, so the cursor is at the end of the new text
+                run_on_main_thread(self.ctx, lambda: self.prefetch_extend_selection(text_range, writer.cursor.getEnd(), document))
+            job_metrics.finish(self.ctx, len(targets))
+
+        return _executor.submit(name, work)
+
+    def edit_selection_chunks(self, text_range):
+        """ Splits a selection longer than edit_selection_chunk_chars on paragraph boundaries.
+            Returns a list of text cursors, each spanning consecutive paragraphs clipped to the
+            selection and holding up to edit_selection_chunk_chars characters, or None if the
+            selection should be edited in one piece.
+        """
+        chunk_chars = self.get_config("edit_selection_chunk_chars", 3000)
+        if chunk_chars <= 0 or len(text_range.getString()) <= chunk_chars:
+            return None
 
-        # Write the updated configuration back to the file
+        text = text_range.getText()
+        chunks = []
+        cursor = None
         try:
-            with open(config_file_path, 'w') as file:
-                json.dump(config_data, file, indent=4)
-        except IOError as e:
-            # Handle potential IO errors (optional)
-            print(f"Error writing to {config_file_path}: {e}")
+            paragraphs = text_range.createEnumeration()
+            while paragraphs.hasMoreElements():
+                paragraph = paragraphs.nextElement()
+                # tables and other text content are left alone
+                if not paragraph.supportsService("com.sun.star.text.Paragraph"):
+                    cursor = None
+                    continue
+                # clip the first and last paragraph to the selection
+                start = text_range.getStart() if text.compareRegionStarts(paragraph, text_range) > 0 else paragraph.getStart()
+                end = text_range.getEnd() if text.compareRegionEnds(paragraph, text_range) < 0 else paragraph.getEnd()
+                if cursor is not None:
+                    grown = text.createTextCursorByRange(cursor.getStart())
+                    grown.gotoRange(end, True)
+                    if len(grown.getString()) <= chunk_chars:
+                        cursor = grown
+                        chunks[-1] = cursor
+                        continue
+                cursor = text.createTextCursorByRange(start)
+                cursor.gotoRange(end, True)
+                chunks.append(cursor)
+        except Exception as e:
+            # e.g. a selection spanning several table cells, which don't share one XText
+            log_to_file("could not split selection into paragraphs: " + str(e))
+            return None
+        return chunks if len(chunks) > 1 else None
+
+    def submit_chunked_edit_job(self, name, chunks, user_input, document=None):
+        """ Edits each chunk on a pool of edit_selection_concurrency threads per endpoint. Finished chunks
+            are replaced in place, in document order, as soon as all chunks before them are done;
+            with edit_selection_diff only the words that changed are replaced. The job is one undo action.
+        """
+        # the concurrency setting is per endpoint
+        concurrency = max(1, int(self.get_config("edit_selection_concurrency", 4))) * len(self.endpoints())
+        originals = [chunk.getString() for chunk in chunks]
+        # only the words that changed are replaced, see apply_text_edit
+        diff = self.get_config("edit_selection_diff", True)
+        job_metrics = JobMetrics(name)
+        thinking = ThinkingIndicator(self.ctx, document, "localwriter: " + name)
+        index = self.document_index(document)
+        errors = []
+
+        def process(job, text):
+            if job.is_cancelled() or text.strip() == "":
+                return None
+            try:
+                request = self.edit_selection_request(text, user_input, excerpts=self.retrieve(index, text + "\n" + user_input, text))
+                request.indicator = thinking
+                return self.completion(request)
+            except Exception as e:
+                # the paragraphs keep their original text
+                errors.append("paragraphs starting with \"" + text[:40].strip() + "\": " + str(e))
+                return None
+
+        undo = UndoGroup(document, "localwriter: " + name)
+
+        def replace(ready):
+            def set_strings():
+                for index, new_text in ready:
+                    if diff:
+                        apply_text_edit(chunks[index], originals[index], new_text)
+                    else:
+                        chunks[index].setString(new_text)
+            undo.run(lambda: bulk_update(document, set_strings))
+
+        def work(job):
+            import concurrent.futures
+            results = {}
+            next_index = 0
+            with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="localwriter-edit") as pool:
+                futures = {pool.submit(process, job, text): index for index, text in enumerate(originals)}
+                for future in concurrent.futures.as_completed(futures):
+                    results[futures[future]] = future.result()
+                    ready = []
+                    while next_index in results:
+                        new_text = results.pop(next_index)
+                        if new_text is not None:
+                            ready.append((next_index, new_text))
+                        next_index += 1
+                    if ready:
+                        run_on_main_thread(self.ctx, lambda ready=ready: job_metrics.timed(replace)(ready))
+            if errors:
+                self.report_errors(name + ": " + str(len(errors)) + " of " + str(len(originals)) + " parts failed", errors,
+                                   "The other parts were edited, the failed ones were left unchanged.")
+            job_metrics.finish(self.ctx, len(originals))
+
+        return _executor.submit(name, work)
+
+    def calc_batch_budgets(self, name, text):
+        # (prompt tokens, expected output tokens) of one cell in a batched prompt,
+        # with a few tokens for its number and the JSON punctuation
+        key = self.token_estimate_key()
+        if name == "ExtendSelection":
+            output = self.get_config("extend_selection_max_tokens", 70)
+        else:
+            output = int(_token_estimator.estimate(text, key) * EDIT_TOKEN_HEADROOM) + self.get_config("edit_selection_max_new_tokens", 0)
+        return _token_estimator.estimate(json.dumps(text), key) + 8, output + 8
 
+    def calc_batches(self, name, texts, user_input):
+        """ Groups cell texts into batches whose prompt and expected output together fit into
+            calc_batch_tokens (and the context_max_tokens window), with at most
+            calc_batch_max_cells cells each. Returns a list of lists of texts.
+        """
+        budget = min(self.get_config("calc_batch_tokens", 2048), self.get_config("context_max_tokens", 4096))
+        max_cells = max(1, int(self.get_config("calc_batch_max_cells", 50)))
+        system_prompt = self.get_config("extend_selection_system_prompt" if name == "ExtendSelection" else "edit_selection_system_prompt", "")
+        overhead = _token_estimator.estimate(self.calc_batch_prompt(name, [], user_input) + system_prompt, self.token_estimate_key())
+        batches = []
+        batch, used = [], overhead
+        for text in texts:
+            tokens = sum(self.calc_batch_budgets(name, text))
+            if batch and (used + tokens > budget or len(batch) >= max_cells):
+                batches.append(batch)
+                batch, used = [], overhead
+            batch.append(text)
+            used += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def calc_batch_prompt(self, name, texts, user_input):
+        numbered = json.dumps({str(i + 1): text for i, text in enumerate(texts)}, ensure_ascii=False, indent=0)
+        if name == "ExtendSelection":
+            return ("Continue each of the following texts. The texts are given as a JSON object that maps numbers to texts. "
+                    "Reply only with a JSON object that maps the same numbers to the continuation of each text, without repeating the text.\n"
+                    "TEXTS:\n" + numbered + "\nCONTINUATIONS:\n")
+        return ("Edit each of the following texts according to the instructions. The texts are given as a JSON object that maps numbers to texts. "
+                "Reply only with a JSON object that maps the same numbers to the edited version of each text. There are no comments in the edited versions. "
+                "Don't waste time thinking, be as fast as you can.\nINSTRUCTIONS:\n" + user_input + "\nTEXTS:\n" + numbered + "\nEDITED TEXTS:\n")
+
+    def calc_batch_request(self, name, texts, user_input):
+        """ Returns a CompletionRequest that handles all texts in one prompt."""
+        metrics = RequestMetrics(name + "Batch")
+        system_prompt = self.get_config("extend_selection_system_prompt" if name == "ExtendSelection" else "edit_selection_system_prompt", "")
+        max_tokens = sum(self.calc_batch_budgets(name, text)[1] for text in texts) + 8
+        request = self.backend_adapter().build(system_prompt, self.calc_batch_prompt(name, texts, user_input), self.sampling_params(max_tokens))
+        request.metrics = metrics
+        metrics.built()
+        return request
+
+    def submit_calc_job(self, name, ranges, user_input="", document=None):
+        """ Runs the per-cell requests of one or more cell ranges on the generation worker.
+            ranges holds (cell_range, data_array, cells) tuples, with the range contents from
+            getDataArray() and the (row, column) positions within it to process, None for all.
+            Numeric cells are read as the text they show, so call it on the main thread.
+            Prompts are dispatched through a pool of calc_concurrency threads per endpoint,
+            identical cells (also across ranges) are only sent once. Each range is written back in
+            its own main thread callback as soon as all of its cells are done, with setDataArray() on
+            blocks of at most calc_write_block_rows rows that hold only changed cells. The job is one undo action.
+            Failed cells keep their contents and are added to the retry queue.
+            With calc_batch enabled, cells are first sent packed into batched prompts;
+            cells missing from a batch's reply fall back to their own request.
+            @param document the document of the ranges
+        """
+        concurrency = max(1, int(self.get_config("calc_concurrency", 4))) * len(self.endpoints())
+        batch_mode = self.get_config("calc_batch", False)
+        block_rows = max(1, int(self.get_config("calc_write_block_rows", 500)))
+
+        # identical cells are sent once and the result is copied to all of them
+        positions = collections.OrderedDict()
+        targets = []
+        for index, (cell_range, data_array, cells) in enumerate(ranges):
+            rows = [list(row) for row in data_array]
+            if cells is None:
+                cells = [(r, c) for r, row in enumerate(rows) for c in range(len(row))]
+            # waiting counts the cells of the range that don't have a result yet
+            target = {"range": cell_range, "area": cell_range.getRangeAddress(), "rows": rows,
+                      "waiting": 0, "committed": False, "changed": [], "failed": []}
+            for r, c in cells:
+                text = rows[r][c]
+                if not isinstance(text, str):
+                    # getDataArray() returns numbers as doubles, the cell has the text it shows
+                    # with its number format (dates, percentages, currencies)
+                    text = cell_range.getCellByPosition(c, r).getString()
+                if name == "EditSelection" or len(text) > 0:
+                    positions.setdefault(text, []).append((index, r, c))
+                    target["waiting"] += 1
+            targets.append(target)
+        texts = list(positions)
+        cell_count = sum(len(cells_with_text) for cells_with_text in positions.values())
+        job_metrics = JobMetrics(name)
+        undo = UndoGroup(document, "localwriter: " + name)
+        thinking = ThinkingIndicator(self.ctx, document, "localwriter: " + name)
+
+        def process(job, text):
+            if job.is_cancelled():
+                return None
+            if name == "ExtendSelection":
+                request = self.extend_selection_request(text)
+            else:
+                request = self.edit_selection_request(text, user_input, calc=True)
+            request.indicator = thinking
+            new_text = self.completion(request)
+            return text + new_text if name == "ExtendSelection" else new_text
+
+        def process_batch(job, batch):
+            if job.is_cancelled():
+                return {}
+            request = self.calc_batch_request(name, batch, user_input)
+            request.indicator = thinking
+            results = parse_batch_response(self.completion(request), len(batch))
+            if name == "ExtendSelection":
+                results = {i: batch[i] + continuation for i, continuation in results.items()}
+            return results
+
+        def write_back(target):
+            # setDataArray() replaces all contents of the cells it covers, notes included, so it
+            # only covers changed cells, and cells with a note get setString() like before
+            from com.sun.star.sheet.CellFlags import ANNOTATION
+            cell_range, area, rows = target["range"], target["area"], target["rows"]
+            changed = set(target["changed"])
+            for noted in cell_range.queryContentCells(ANNOTATION).getRangeAddresses():
+                for r in range(noted.StartRow - area.StartRow, noted.EndRow - area.StartRow + 1):
+                    for c in range(noted.StartColumn - area.StartColumn, noted.EndColumn - area.StartColumn + 1):
+                        if (r, c) in changed:
+                            changed.discard((r, c))
+                            cell_range.getCellByPosition(c, r).setString(rows[r][c])
+            for first_row, first_column, last_row, last_column in changed_blocks(changed, block_rows):
+                data = tuple(tuple(rows[r][first_column:last_column + 1]) for r in range(first_row, last_row + 1))
+                cell_range.getCellRangeByPosition(first_column, first_row, last_column, last_row).setDataArray(data)
+
+        def commit(target):
+            target["committed"] = True
+            if target["changed"]:
+                run_on_main_thread(self.ctx, job_metrics.timed(lambda: undo.run(lambda: bulk_update(document, lambda: write_back(target)))))
+
+        def work(job):
+            import concurrent.futures
+            requests = 0
+            errors = []
+
+            def resolve(text, new_text=None, error=None):
+                # records the outcome for every cell holding text, and writes back each range
+                # once none of its cells is waiting any more
+                for index, r, c in positions[text]:
+                    target = targets[index]
+                    if error is not None:
+                        target["failed"].append((r, c))
+                        area = target["area"]
+                        errors.append(cell_name(area.StartColumn + c, area.StartRow + r) + ": " + str(error))
+                    elif new_text is not None:
+                        target["rows"][r][c] = new_text
+                        target["changed"].append((r, c))
+                    target["waiting"] -= 1
+                    if target["waiting"] == 0:
+                        commit(target)
+
+            single = texts
+            try:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="localwriter-calc") as pool:
+                    if batch_mode and len(texts) > 1:
+                        single = []
+                        batches = self.calc_batches(name, texts, user_input)
+                        requests += len(batches)
+                        futures = {pool.submit(process_batch, job, batch): batch for batch in batches}
+                        for future in concurrent.futures.as_completed(futures):
+                            batch = futures[future]
+                            try:
+                                results = future.result()
+                            except Exception as e:
+                                log_to_file("calc batch of " + str(len(batch)) + " cells failed: " + str(e))
+                                results = {}
+                            for i, text in enumerate(batch):
+                                if i in results:
+                                    resolve(text, results[i])
+                                else:
+                                    single.append(text)
+                        if job.is_cancelled():
+                            for text in single:
+                                resolve(text)
+                            single = []
+                        elif single:
+                            log_to_file(str(len(single)) + " of " + str(len(texts)) + " distinct cells were missing from the batch replies, sending them one by one")
+                    requests += len(single)
+                    futures = {pool.submit(process, job, text): text for text in single}
+                    for future in concurrent.futures.as_completed(futures):
+                        text = futures[future]
+                        try:
+                            new_text = future.result()
+                        except Exception as e:
+                            resolve(text, error=e)
+                            continue
+                        resolve(text, new_text)
+            finally:
+                # what is done is written back even if the job failed
+                for target in targets:
+                    if not target["committed"]:
+                        commit(target)
+
+            if errors:
+                for target in targets:
+                    if target["failed"]:
+                        _calc_retry_queue.add(name, target["range"], user_input, sorted(target["failed"]), document)
+                self.report_errors(name + ": " + str(len(errors)) + " of " + str(cell_count) + " cells failed", sorted(errors),
+                                   "The failed cells were left unchanged. Use localwriter > Retry Failed Cells to run only them again.")
+            if cell_count > len(texts):
+                log_to_file(name + ": " + str(cell_count) + " cells with " + str(len(texts)) + " distinct values, "
+                            + str(cell_count - len(texts)) + " requests saved")
+            job_metrics.finish(self.ctx, requests, cell_count - len(texts))
+
+        return _executor.submit(name, work)
+
+    def warm_up(self, force=False):
+        """ Loads the configured Ollama model in the background if ollama_warmup is enabled."""
+        if not self.get_config("ollama_warmup", False):
+            return
+        model = self.get_config("model", "")
+        if self.get_config("api_type", "completions") not in ("ollama", "ollama_chat") or model == "":
+            return
+        _warmer.warm({
+            "endpoints": self.endpoints(),
+            "model": model,
+            "keep_alive": self.get_config("ollama_keep_alive", "30m") or "5m",
+            "idle_seconds": float(self.get_config("ollama_idle_minutes", 30)) * 60,
+            "read_timeout": self.get_config("read_timeout", 300),
+        }, force)
+
+    def execute(self, args):
+        # XJob, registered in Jobs.xcu for documents being opened, created or focused
+        try:
+            # runs on every focus change, so return before anything else while warm-up is off
+            if not self.get_config("ollama_warmup", False):
+                return None
+            model = named_values(named_values(args).get("Environment")).get("Model")
+            if hasattr(model, "Text") or hasattr(model, "Sheets"):
+                _warmer.touch()
+                self.warm_up()
+        except Exception as e:
+            log_to_file("warm-up job failed: " + str(e))
+        return None
+
+    def apply_settings(self, result):
+        values = {}
+        for key in ("extend_selection_max_tokens", "extend_selection_system_prompt",
+                    "edit_selection_max_new_tokens", "edit_selection_system_prompt", "model"):
+            if key in result:
+                values[key] = result[key]
+
+        if "endpoint" in result:
+            endpoints = parse_endpoints(result["endpoint"])
+            if endpoints and all(endpoint.startswith("http") for endpoint in endpoints):
+                values["endpoint"] = endpoints[0] if len(endpoints) == 1 else endpoints
+
+        if values:
+            self.set_configs(values)
+            # the model or endpoint may have changed
+            self.warm_up(force=True)
+
+    def report_errors(self, title, errors, note=""):
+        """ Logs the errors of a job and lists them in one message box, instead of
+            writing them into the document.
+        """
+        for error in errors:
+            log_to_file(title + ": " + error)
+        if self.errors is not None:
+            self.errors.extend(title + ": " + error for error in errors)
+            return
+        message = "\n".join(errors[:10])
+        if len(errors) > 10:
+            message += "\n... and " + str(len(errors) - 10) + " more, see log.txt"
+        if note:
+            message += "\n\n" + note
+        run_on_main_thread(self.ctx, lambda: self.message_box(message, "localwriter: " + title))
+
+    def retry_failed_cells(self):
+        # only the cells of the current document, another one's may be retried from there
+        model = get_service(self.ctx, "com.sun.star.frame.Desktop").getCurrentComponent()
+        entries = _calc_retry_queue.take(model) if model is not None else []
+        if not entries:
+            self.message_box("There are no failed cells to retry in this document.", "localwriter")
+            return
+        failed = []
+        errors = []
+        for entry in entries:
+            name, cell_range, user_input, cells, document = entry
+            try:
+                # re-read the range, the successful cells were written back in the meantime
+                self.submit_calc_job(name, [(cell_range, cell_range.getDataArray(), cells)], user_input, document)
+            except Exception as e:
+                failed.append(entry)
+                errors.append(str(e))
+        if failed:
+            # kept for the next Retry Failed Cells
+            _calc_retry_queue.put_back(failed)
+            self.report_errors("retry of " + str(len(failed)) + " of " + str(len(entries)) + " ranges failed", errors,
+                               "Their cells stay in the list of failed cells.")
+
+    def message_box(self, message, title=""):
+        """ Shows message in an information box on top of the current window."""
+        from com.sun.star.awt.MessageBoxType import INFOBOX
+        frame = get_service(self.ctx, "com.sun.star.frame.Desktop").getCurrentFrame()
+        window = frame.getContainerWindow() if frame else None
+        toolkit = get_service(self.ctx, "com.sun.star.awt.Toolkit")
+        box = toolkit.createMessageBox(window, INFOBOX, MSG_BUTTONS.BUTTONS_OK, title, message)
+        box.execute()
+        box.dispose()
+
+    def log_dialog_latency(self, name, reused):
+        # time from the menu command or hotkey until the dialog is about to be shown
+        if self.triggered is not None:
+            log_to_file(name + " dialog ready " + str(round((time.perf_counter() - self.triggered) * 1000, 1))
+                        + " ms after the command (" + ("reused" if reused else "built") + ")")
 
     #retrieved from https://wiki.documentfoundation.org/Macros/General/IO_to_Screen
     #License: Creative Commons Attribution-ShareAlike 3.0 Unported License,
@@ -137,29 +2937,34 @@ class MainJob(unohelper.Base, XJobExecutor):
         ctx = uno.getComponentContext()
         def create(name):
             return ctx.getServiceManager().createInstanceWithContext(name, ctx)
-        dialog = create("com.sun.star.awt.UnoControlDialog")
-        dialog_model = create("com.sun.star.awt.UnoControlDialogModel")
-        dialog.setModel(dialog_model)
-        dialog.setVisible(False)
-        dialog.setTitle(title)
-        dialog.setPosSize(0, 0, WIDTH, HEIGHT, SIZE)
-        def add(name, type, x_, y_, width_, height_, props):
-            model = dialog_model.createInstance("com.sun.star.awt.UnoControl" + type + "Model")
-            dialog_model.insertByName(name, model)
-            control = dialog.getControl(name)
-            control.setPosSize(x_, y_, width_, height_, POSSIZE)
-            for key, value in props.items():
-                setattr(model, key, value)
-        label_width = WIDTH - BUTTON_WIDTH - HORI_SEP - HORI_MARGIN * 2
-        add("label", "FixedText", HORI_MARGIN, VERT_MARGIN, label_width, LABEL_HEIGHT, 
-            {"Label": str(message), "NoLabel": True})
-        add("btn_ok", "Button", HORI_MARGIN + label_width + HORI_SEP, VERT_MARGIN, 
-                BUTTON_WIDTH, BUTTON_HEIGHT, {"PushButtonType": OK, "DefaultButton": True})
-        add("edit", "Edit", HORI_MARGIN, LABEL_HEIGHT + VERT_MARGIN + VERT_SEP, 
-                WIDTH - HORI_MARGIN * 2, EDIT_HEIGHT, {"Text": str(default)})
-        frame = create("com.sun.star.frame.Desktop").getCurrentFrame()
+        frame = get_service(ctx, "com.sun.star.frame.Desktop").getCurrentFrame()
         window = frame.getContainerWindow() if frame else None
-        dialog.createPeer(create("com.sun.star.awt.Toolkit"), window)
+        dialog = cached_dialog("input", window)
+        reused = dialog is not None
+        if not reused:
+            dialog = create("com.sun.star.awt.UnoControlDialog")
+            dialog_model = create("com.sun.star.awt.UnoControlDialogModel")
+            dialog.setModel(dialog_model)
+            dialog.setVisible(False)
+            dialog.setPosSize(0, 0, WIDTH, HEIGHT, SIZE)
+            def add(name, type, x_, y_, width_, height_, props):
+                model = dialog_model.createInstance("com.sun.star.awt.UnoControl" + type + "Model")
+                dialog_model.insertByName(name, model)
+                control = dialog.getControl(name)
+                control.setPosSize(x_, y_, width_, height_, POSSIZE)
+                for key, value in props.items():
+                    setattr(model, key, value)
+            label_width = WIDTH - BUTTON_WIDTH - HORI_SEP - HORI_MARGIN * 2
+            add("label", "FixedText", HORI_MARGIN, VERT_MARGIN, label_width, LABEL_HEIGHT, 
+                {"NoLabel": True})
+            add("btn_ok", "Button", HORI_MARGIN + label_width + HORI_SEP, VERT_MARGIN, 
+                    BUTTON_WIDTH, BUTTON_HEIGHT, {"PushButtonType": OK, "DefaultButton": True})
+            add("edit", "Edit", HORI_MARGIN, LABEL_HEIGHT + VERT_MARGIN + VERT_SEP, 
+                    WIDTH - HORI_MARGIN * 2, EDIT_HEIGHT, {})
+            dialog.createPeer(get_service(ctx, "com.sun.star.awt.Toolkit"), window)
+            store_dialog("input", window, dialog)
+        dialog.setTitle(title)
+        dialog.getControl("label").getModel().Label = str(message)
         if not x is None and not y is None:
             ps = dialog.convertSizeToPixel(uno.createUnoStruct("com.sun.star.awt.Size", x, y), TWIP)
             _x, _y = ps.Width, ps.Height
@@ -169,10 +2974,11 @@ class MainJob(unohelper.Base, XJobExecutor):
             _y = ps.Height / 2 - HEIGHT / 2
         dialog.setPosSize(_x, _y, 0, 0, POS)
         edit = dialog.getControl("edit")
+        edit.getModel().Text = str(default)
         edit.setSelection(uno.createUnoStruct("com.sun.star.awt.Selection", 0, len(str(default))))
         edit.setFocus()
+        self.log_dialog_latency("input", reused)
         ret = edit.getModel().Text if dialog.execute() else ""
-        dialog.dispose()
         return ret
 
     def settings_box(self,title="", x=None, y=None):
@@ -200,57 +3006,59 @@ class MainJob(unohelper.Base, XJobExecutor):
         ctx = uno.getComponentContext()
         def create(name):
             return ctx.getServiceManager().createInstanceWithContext(name, ctx)
-        dialog = create("com.sun.star.awt.UnoControlDialog")
-        dialog_model = create("com.sun.star.awt.UnoControlDialogModel")
-        dialog.setModel(dialog_model)
-        dialog.setVisible(False)
-        dialog.setTitle(title)
-        dialog.setPosSize(0, 0, WIDTH, HEIGHT, SIZE)
-        def add(name, type, x_, y_, width_, height_, props):
-            model = dialog_model.createInstance("com.sun.star.awt.UnoControl" + type + "Model")
-            dialog_model.insertByName(name, model)
-            control = dialog.getControl(name)
-            control.setPosSize(x_, y_, width_, height_, POSSIZE)
-            for key, value in props.items():
-                setattr(model, key, value)
-        label_width = WIDTH - BUTTON_WIDTH - HORI_SEP - HORI_MARGIN * 2
-        add("label_endpoint", "FixedText", HORI_MARGIN, VERT_MARGIN, label_width, LABEL_HEIGHT, 
-            {"Label": "Endpoint URL/Port:", "NoLabel": True})
-        add("btn_ok", "Button", HORI_MARGIN + label_width + HORI_SEP, VERT_MARGIN, 
-                BUTTON_WIDTH, BUTTON_HEIGHT, {"PushButtonType": OK, "DefaultButton": True})
-        add("edit_endpoint", "Edit", HORI_MARGIN, LABEL_HEIGHT,
-                WIDTH - HORI_MARGIN * 2, EDIT_HEIGHT, {"Text": str(self.get_config("endpoint","http://127.0.0.1:5000"))})
-        
-        add("label_model", "FixedText", HORI_MARGIN, LABEL_HEIGHT + VERT_MARGIN + VERT_SEP + EDIT_HEIGHT, label_width, LABEL_HEIGHT, 
-            {"Label": "Model (Required by Ollama):", "NoLabel": True})
-        add("edit_model", "Edit", HORI_MARGIN, LABEL_HEIGHT*2 + VERT_MARGIN + VERT_SEP*2 + EDIT_HEIGHT, 
-                WIDTH - HORI_MARGIN * 2, EDIT_HEIGHT, {"Text": str(self.get_config("model",""))})
-        
-        add("label_extend_selection_max_tokens", "FixedText", HORI_MARGIN, LABEL_HEIGHT*3 + VERT_MARGIN + VERT_SEP*3 + EDIT_HEIGHT, label_width, LABEL_HEIGHT, 
-            {"Label": "Extend Selection Max Tokens:", "NoLabel": True})
-        add("edit_extend_selection_max_tokens", "Edit", HORI_MARGIN, LABEL_HEIGHT*4 + VERT_MARGIN + VERT_SEP*4 + EDIT_HEIGHT, 
-                WIDTH - HORI_MARGIN * 2, EDIT_HEIGHT, {"Text": str(self.get_config("extend_selection_max_tokens","70"))})
-        
-        add("label_extend_selection_system_prompt", "FixedText", HORI_MARGIN, LABEL_HEIGHT*5 + VERT_MARGIN + VERT_SEP*5 + EDIT_HEIGHT, label_width, LABEL_HEIGHT, 
-            {"Label": "Extend Selection System Prompt:", "NoLabel": True})
-        add("edit_extend_selection_system_prompt", "Edit", HORI_MARGIN, LABEL_HEIGHT*6 + VERT_MARGIN + VERT_SEP*6 + EDIT_HEIGHT, 
-                WIDTH - HORI_MARGIN * 2, EDIT_HEIGHT, {"Text": str(self.get_config("extend_selection_system_prompt",""))})
-
-        add("label_edit_selection_max_new_tokens", "FixedText", HORI_MARGIN, LABEL_HEIGHT*7 + VERT_MARGIN + VERT_SEP*7 + EDIT_HEIGHT, label_width, LABEL_HEIGHT, 
-            {"Label": "Edit Selection Max New Tokens:", "NoLabel": True})
-        add("edit_edit_selection_max_new_tokens", "Edit", HORI_MARGIN, LABEL_HEIGHT*8 + VERT_MARGIN + VERT_SEP*8 + EDIT_HEIGHT, 
-                WIDTH - HORI_MARGIN * 2, EDIT_HEIGHT, {"Text": str(self.get_config("edit_selection_max_new_tokens",""))})
-
-        add("label_edit_selection_system_prompt", "FixedText", HORI_MARGIN, LABEL_HEIGHT*9 + VERT_MARGIN + VERT_SEP*9 + EDIT_HEIGHT, label_width, LABEL_HEIGHT, 
-            {"Label": "Edit Selection System Prompt:", "NoLabel": True})
-        add("edit_edit_selection_system_prompt", "Edit", HORI_MARGIN, LABEL_HEIGHT*10 + VERT_MARGIN + VERT_SEP*10 + EDIT_HEIGHT, 
-                WIDTH - HORI_MARGIN * 2, EDIT_HEIGHT, {"Text": str(self.get_config("edit_selection_system_prompt",""))})
-
-
-
-        frame = create("com.sun.star.frame.Desktop").getCurrentFrame()
+        frame = get_service(ctx, "com.sun.star.frame.Desktop").getCurrentFrame()
         window = frame.getContainerWindow() if frame else None
-        dialog.createPeer(create("com.sun.star.awt.Toolkit"), window)
+        dialog = cached_dialog("settings", window)
+        reused = dialog is not None
+        if not reused:
+            dialog = create("com.sun.star.awt.UnoControlDialog")
+            dialog_model = create("com.sun.star.awt.UnoControlDialogModel")
+            dialog.setModel(dialog_model)
+            dialog.setVisible(False)
+            dialog.setPosSize(0, 0, WIDTH, HEIGHT, SIZE)
+            def add(name, type, x_, y_, width_, height_, props):
+                model = dialog_model.createInstance("com.sun.star.awt.UnoControl" + type + "Model")
+                dialog_model.insertByName(name, model)
+                control = dialog.getControl(name)
+                control.setPosSize(x_, y_, width_, height_, POSSIZE)
+                for key, value in props.items():
+                    setattr(model, key, value)
+            label_width = WIDTH - BUTTON_WIDTH - HORI_SEP - HORI_MARGIN * 2
+            add("label_endpoint", "FixedText", HORI_MARGIN, VERT_MARGIN, label_width, LABEL_HEIGHT, 
+                {"Label": "Endpoint URL/Port:", "NoLabel": True})
+            add("btn_ok", "Button", HORI_MARGIN + label_width + HORI_SEP, VERT_MARGIN, 
+                    BUTTON_WIDTH, BUTTON_HEIGHT, {"PushButtonType": OK, "DefaultButton": True})
+            add("edit_endpoint", "Edit", HORI_MARGIN, LABEL_HEIGHT,
+                    WIDTH - HORI_MARGIN * 2, EDIT_HEIGHT, {})
+            
+            add("label_model", "FixedText", HORI_MARGIN, LABEL_HEIGHT + VERT_MARGIN + VERT_SEP + EDIT_HEIGHT, label_width, LABEL_HEIGHT, 
+                {"Label": "Model (Required by Ollama):", "NoLabel": True})
+            add("edit_model", "Edit", HORI_MARGIN, LABEL_HEIGHT*2 + VERT_MARGIN + VERT_SEP*2 + EDIT_HEIGHT, 
+                    WIDTH - HORI_MARGIN * 2, EDIT_HEIGHT, {})
+            
+            add("label_extend_selection_max_tokens", "FixedText", HORI_MARGIN, LABEL_HEIGHT*3 + VERT_MARGIN + VERT_SEP*3 + EDIT_HEIGHT, label_width, LABEL_HEIGHT, 
+                {"Label": "Extend Selection Max Tokens:", "NoLabel": True})
+            add("edit_extend_selection_max_tokens", "Edit", HORI_MARGIN, LABEL_HEIGHT*4 + VERT_MARGIN + VERT_SEP*4 + EDIT_HEIGHT, 
+                    WIDTH - HORI_MARGIN * 2, EDIT_HEIGHT, {})
+            
+            add("label_extend_selection_system_prompt", "FixedText", HORI_MARGIN, LABEL_HEIGHT*5 + VERT_MARGIN + VERT_SEP*5 + EDIT_HEIGHT, label_width, LABEL_HEIGHT, 
+                {"Label": "Extend Selection System Prompt:", "NoLabel": True})
+            add("edit_extend_selection_system_prompt", "Edit", HORI_MARGIN, LABEL_HEIGHT*6 + VERT_MARGIN + VERT_SEP*6 + EDIT_HEIGHT, 
+                    WIDTH - HORI_MARGIN * 2, EDIT_HEIGHT, {})
+
+            add("label_edit_selection_max_new_tokens", "FixedText", HORI_MARGIN, LABEL_HEIGHT*7 + VERT_MARGIN + VERT_SEP*7 + EDIT_HEIGHT, label_width, LABEL_HEIGHT, 
+                {"Label": "Edit Selection Max New Tokens:", "NoLabel": True})
+            add("edit_edit_selection_max_new_tokens", "Edit", HORI_MARGIN, LABEL_HEIGHT*8 + VERT_MARGIN + VERT_SEP*8 + EDIT_HEIGHT, 
+                    WIDTH - HORI_MARGIN * 2, EDIT_HEIGHT, {})
+
+            add("label_edit_selection_system_prompt", "FixedText", HORI_MARGIN, LABEL_HEIGHT*9 + VERT_MARGIN + VERT_SEP*9 + EDIT_HEIGHT, label_width, LABEL_HEIGHT, 
+                {"Label": "Edit Selection System Prompt:", "NoLabel": True})
+            add("edit_edit_selection_system_prompt", "Edit", HORI_MARGIN, LABEL_HEIGHT*10 + VERT_MARGIN + VERT_SEP*10 + EDIT_HEIGHT, 
+                    WIDTH - HORI_MARGIN * 2, EDIT_HEIGHT, {})
+
+            dialog.createPeer(get_service(ctx, "com.sun.star.awt.Toolkit"), window)
+            store_dialog("settings", window, dialog)
+        dialog.setTitle(title)
         if not x is None and not y is None:
             ps = dialog.convertSizeToPixel(uno.createUnoStruct("com.sun.star.awt.Size", x, y), TWIP)
             _x, _y = ps.Width, ps.Height
@@ -259,29 +3067,30 @@ class MainJob(unohelper.Base, XJobExecutor):
             _x = ps.Width / 2 - WIDTH / 2
             _y = ps.Height / 2 - HEIGHT / 2
         dialog.setPosSize(_x, _y, 0, 0, POS)
-        
+
+        # the dialog may be reused, so the fields are filled in every time it is shown
+        values = {
+            "edit_endpoint": ", ".join(self.endpoints()),
+            "edit_model": str(self.get_config("model","")),
+            "edit_extend_selection_max_tokens": str(self.get_config("extend_selection_max_tokens","70")),
+            "edit_extend_selection_system_prompt": str(self.get_config("extend_selection_system_prompt","")),
+            "edit_edit_selection_max_new_tokens": str(self.get_config("edit_selection_max_new_tokens","")),
+            "edit_edit_selection_system_prompt": str(self.get_config("edit_selection_system_prompt","")),
+        }
+        for name, value in values.items():
+            control = dialog.getControl(name)
+            control.getModel().Text = value
+            control.setSelection(uno.createUnoStruct("com.sun.star.awt.Selection", 0, len(value)))
+
         edit_endpoint = dialog.getControl("edit_endpoint")
-        edit_endpoint.setSelection(uno.createUnoStruct("com.sun.star.awt.Selection", 0, len(str(self.get_config("endpoint","http://127.0.0.1:5000")))))
-        
         edit_model = dialog.getControl("edit_model")
-        edit_model.setSelection(uno.createUnoStruct("com.sun.star.awt.Selection", 0, len(str(self.get_config("model","")))))
-
         edit_extend_selection_max_tokens = dialog.getControl("edit_extend_selection_max_tokens")
-        edit_extend_selection_max_tokens.setSelection(uno.createUnoStruct("com.sun.star.awt.Selection", 0, len(str(self.get_config("extend_selection_max_tokens","70")))))
-
-
         edit_extend_selection_system_prompt = dialog.getControl("edit_extend_selection_system_prompt")
-        edit_extend_selection_system_prompt.setSelection(uno.createUnoStruct("com.sun.star.awt.Selection", 0, len(str(self.get_config("extend_selection_system_prompt","")))))
-
-
         edit_edit_selection_max_new_tokens = dialog.getControl("edit_edit_selection_max_new_tokens")
-        edit_edit_selection_max_new_tokens.setSelection(uno.createUnoStruct("com.sun.star.awt.Selection", 0, len(str(self.get_config("edit_selection_max_new_tokens","0")))))
-
         edit_edit_selection_system_prompt = dialog.getControl("edit_edit_selection_system_prompt")
-        edit_edit_selection_system_prompt.setSelection(uno.createUnoStruct("com.sun.star.awt.Selection", 0, len(str(self.get_config("edit_selection_system_prompt","")))))
-
 
         edit_endpoint.setFocus()
+        self.log_dialog_latency("settings", reused)
 
         if dialog.execute():
             result = {"endpoint":edit_endpoint.getModel().Text, "model": edit_model.getModel().Text, "extend_selection_system_prompt": edit_extend_selection_system_prompt.getModel().Text, "edit_selection_system_prompt": edit_edit_selection_system_prompt.getModel().Text}
@@ -293,343 +3102,419 @@ class MainJob(unohelper.Base, XJobExecutor):
         else:
             result = {}
 
-        dialog.dispose()
         return result
     #end sharealike section 
 
     def trigger(self, args):
-        desktop = self.ctx.ServiceManager.createInstanceWithContext(
-            "com.sun.star.frame.Desktop", self.ctx)
-        model = desktop.getCurrentComponent()
+        self.triggered = time.perf_counter()
+        _warmer.touch()
+        if args == "CancelGeneration":
+            # nothing to look up in the document, just stop whatever the worker is doing
+            cancelled = _executor.cancel_all()
+            _prefetcher.clear()
+            log_to_file("cancelled " + str(cancelled) + " generation job(s)")
+            return
+
+        if args == "Statistics":
+            self.message_box(format_statistics(get_metrics_log(self.ctx).records()), "localwriter statistics")
+            return
+
+        if args == "RetryFailedCells":
+            self.retry_failed_cells()
+            return
+
+        model = get_service(self.ctx, "com.sun.star.frame.Desktop").getCurrentComponent()
         #if not hasattr(model, "Text"):
         #    model = self.desktop.loadComponentFromURL("private:factory/swriter", "_blank", 0, ())
 
+        # Everything below runs on the UNO dispatch thread: only read the document and
+        # ask for input here, the requests themselves are submitted to the generation worker.
         if hasattr(model, "Text"):
             text = model.Text
             selection = model.CurrentController.getSelection()
             text_range = selection.getByIndex(0)
+            # all non-empty ranges of a multi-selection
+            text_ranges = [selection.getByIndex(i) for i in range(selection.getCount())]
+            text_ranges = [r for r in text_ranges if len(r.getString()) > 0]
+            if len(text_ranges) == 1:
+                text_range = text_ranges[0]
 
             
             if args == "ExtendSelection":
                 # Access the current selection
                 #selection = model.CurrentController.getSelection()
                 
-                if len(text_range.getString()) > 0:
+                if len(text_ranges) > 1:
+                    try:
+                        # extend every range at once
+                        self.submit_writer_job(args, self.extend_selection_targets(args, text_ranges, model), replace=False, document=model)
+                    except Exception as e:
+                        self.report_errors(args + " failed", [str(e)])
+                elif len(text_range.getString()) > 0:
                     # Get the first range of the selection
                     #text_range = selection.getByIndex(0)
                     try:
-
-                        url = self.get_config("endpoint", "http://127.0.0.1:5000") + "/v1/completions" 
-                        
-                        
-                        headers = {
-                            'Content-Type': 'application/json'
-                        }
-
-                        prompt = None
-                        if self.get_config("extend_selection_system_prompt", "") != "":
-                            prompt = "SYSTEM PROMPT\n" + self.get_config("extend_selection_system_prompt", "") + "\nEND SYSTEM PROMPT\n" + text_range.getString()
+                        context = self.extend_selection_context(text_range)
+                        prefetched = _prefetcher.take(self.prefetch_key(context))
+                        if prefetched is not None:
+                            log_to_file("using prefetched continuation")
+                            self.submit_writer_job(args, [(text_range, None)], prefetched=prefetched, document=model)
                         else:
-                            prompt = text_range.getString()
-
-                        data = {
-                            'prompt': prompt,
-                            'max_tokens': self.get_config("extend_selection_max_tokens", 70),
-                            'temperature': 1,
-                            'top_p': 0.9,
-                            'seed': 10
-                        }
-
-                        model = self.get_config("model", "")
-                        if model != "":
-                            data["model"] = model
-
-
-                        # Convert data to JSON format
-                        json_data = json.dumps(data).encode('utf-8')
-
-                        # Create a request object with the URL, data, and headers
-                        request = urllib.request.Request(url, data=json_data, headers=headers, method='POST')
-
-                        # Send the request and read the response
-                        with urllib.request.urlopen(request) as response:
-                            response_data = response.read()
-
-                        # If needed, decode the response data
-                        response = json.loads(response_data.decode('utf-8'))
-
-                        # Append completion to selection
-                        selected_text = text_range.getString()
-                        new_text = selected_text + response["choices"][0]["text"]
-
-                        # Set the new text
-                        text_range.setString(new_text)
-                
+                            # Append completion to selection
+                            self.submit_writer_job(args, self.extend_selection_targets(args, [text_range], model, [context]), replace=False, document=model)
                     except Exception as e:
-                        text_range = selection.getByIndex(0)
-                        # Append the user input to the selected text
-                        text_range.setString(text_range.getString() + ": " + str(e))
+                        self.report_errors(args + " failed", [str(e)])
 
             elif args == "EditSelection":
                 # Access the current selection
                 try:
                     user_input= self.input_box("Please enter edit instructions!", "Input", "")
-                    #text_range.setString(text_range.getString() + ": " + user_input)
-                    url = self.get_config("endpoint", "http://127.0.0.1:5000") + "/v1/completions" 
-
-                    headers = {
-                        'Content-Type': 'application/json'
-                    }
-
-                    prompt =  "ORIGINAL VERSION:\n" + text_range.getString() + "\n Below is an edited version according to the following instructions. There are no comments in the edited version. The edited version is followed by the end of the document. The original version will be edited as follows to create the edited versio:\n" + user_input + "\nEDITED VERSION:\n"
-
-                    if self.get_config("edit_selection_system_prompt", "") != "":
-                        prompt = "SYSTEM PROMPT\n" + self.get_config("edit_selection_system_prompt","") + "\nEND SYSTEM PROMPT\n" + prompt
-
-
-                    data = {
-                        'prompt':prompt,
-                        'max_tokens': len(text_range.getString()) + self.get_config("edit_selection_max_new_tokens", 0), # this is a bit hacky, it's actually number of characters + max new tokens, so even if max new tokens is zero, max_tokens will often end up with more tokens than the selected text actually contains.
-                        'temperature': 1,
-                        'top_p': 0.9,
-                        'seed': 10
-                    }
-
-                    model = self.get_config("model", "")
-                    if model != "":
-                        data["model"] = model
-
-                    # Convert data to JSON format
-                    json_data = json.dumps(data).encode('utf-8')
-
-                    # Create a request object with the URL, data, and headers
-                    request = urllib.request.Request(url, data=json_data, headers=headers, method='POST')
-
-                    # Send the request and read the response
-                    with urllib.request.urlopen(request) as response:
-                        response_data = response.read()
-
-                    # If needed, decode the response data
-                    response = json.loads(response_data.decode('utf-8'))
-
-
-                    # replace selection with completion
-                    selected_text = text_range.getString()
-                    new_text = response["choices"][0]["text"]
-
-                    # Set the new text
-                    text_range.setString(new_text)
-
+                    if len(text_ranges) > 1:
+                        # edit every range at once, each one written back as soon as it is done;
+                        # long ones are still split into paragraph groups, edited the same way
+                        parts = []
+                        for r in text_ranges:
+                            parts.extend(self.edit_selection_chunks(r) or [r.getText().createTextCursorByRange(r)])
+                        self.submit_writer_job(args, self.edit_selection_targets(parts, user_input, model), replace=True, document=model)
+                    else:
+                        chunks = self.edit_selection_chunks(text_range)
+                        if chunks:
+                            # long selection: edit it paragraph group by paragraph group
+                            self.submit_chunked_edit_job(args, chunks, user_input, model)
+                        else:
+                            # replace selection with completion
+                            self.submit_writer_job(args, self.edit_selection_targets([text_range], user_input, model), replace=True, document=model)
                 except Exception as e:
-                    text_range = selection.getByIndex(0)
-                    # Append the user input to the selected text
-                    text_range.setString(text_range.getString() + ": " + str(e))
+                    self.report_errors(args + " failed", [str(e)])
             
             elif args == "settings":
                 try:
-
-                    result = self.settings_box("Settings")
-                                    
-                    if "extend_selection_max_tokens" in result:
-                        self.set_config("extend_selection_max_tokens", result["extend_selection_max_tokens"])
-
-                    if "extend_selection_system_prompt" in result:
-                        self.set_config("extend_selection_system_prompt", result["extend_selection_system_prompt"])
-
-                    if "edit_selection_max_new_tokens" in result:
-                        self.set_config("edit_selection_max_new_tokens", result["edit_selection_max_new_tokens"])
-
-                    if "edit_selection_system_prompt" in result:
-                        self.set_config("edit_selection_system_prompt", result["edit_selection_system_prompt"])
-
-                    if "endpoint" in result and result["endpoint"].startswith("http"):
-                        self.set_config("endpoint", result["endpoint"])
-
-                    if "model" in result:                
-                        self.set_config("model", result["model"])
-
-
+                    self.apply_settings(self.settings_box("Settings"))
                 except Exception as e:
-                    text_range = selection.getByIndex(0)
-                    # Append the user input to the selected text
-                    text_range.setString(text_range.getString() + ":error: " + str(e))
+                    self.report_errors("settings failed", [str(e)])
         elif hasattr(model, "Sheets"):
             try:
-                #text_range.setString(text_range.getString() + ": " + user_input)
-                url = self.get_config("endpoint", "http://127.0.0.1:5000") + "/v1/completions" 
                 # Get the active sheet
                 sheet = model.CurrentController.ActiveSheet
                 
                 # Get the current selection (which could be a range of cells)
                 selection = model.CurrentController.Selection
-                
 
+                if args == "settings":
+                    self.apply_settings(self.settings_box("Settings"))
+                    return
+
+                user_input = ""
                 if args == "EditSelection":
                     user_input= self.input_box("Please enter edit instructions!", "Input", "")
 
 
-                area = selection.getRangeAddress()
-                start_row = area.StartRow
-                end_row = area.EndRow
-                start_col = area.StartColumn
-                end_col = area.EndColumn
-
-                col_range = range(start_col, end_col + 1)
-                row_range = range(start_row, end_row + 1)
-
-                for row in row_range:
-                    new_values = []
-                    for col in col_range:
-                        cell = sheet.getCellByPosition(col, row)
-
-
-                        if args == "ExtendSelection":
-                            
-                            if len(cell.getString()) > 0:
-                                try:
-
-                                    url = self.get_config("endpoint", "http://127.0.0.1:5000") + "/v1/completions" 
-                                    
-                                    
-                                    headers = {
-                                        'Content-Type': 'application/json'
-                                    }
-
-                                    prompt = None
-                                    if self.get_config("extend_selection_system_prompt", "") != "":
-                                        prompt = "SYSTEM PROMPT\n" + self.get_config("extend_selection_system_prompt", "") + "\nEND SYSTEM PROMPT\n" + cell.getString()
-                                    else:
-                                        prompt = cell.getString()
-
-                                    data = {
-                                        'prompt': prompt,
-                                        'max_tokens': self.get_config("extend_selection_max_tokens", 70),
-                                        'temperature': 1,
-                                        'top_p': 0.9,
-                                        'seed': 10
-                                    }
-
-                                    model = self.get_config("model", "")
-                                    if model != "":
-                                        data["model"] = model
-
-
-                                    # Convert data to JSON format
-                                    json_data = json.dumps(data).encode('utf-8')
-
-                                    # Create a request object with the URL, data, and headers
-                                    request = urllib.request.Request(url, data=json_data, headers=headers, method='POST')
-
-                                    # Send the request and read the response
-                                    with urllib.request.urlopen(request) as response:
-                                        response_data = response.read()
-
-                                    # If needed, decode the response data
-                                    response = json.loads(response_data.decode('utf-8'))
-
-                                    # Append completion to selection
-                                    selected_text = cell.getString()
-                                    new_text = selected_text + response["choices"][0]["text"]
-
-                                    # Set the new text
-                                    cell.setString(new_text)
-                                except Exception as e:
-                                    # Append the user input to the selected text
-                                    cell.setString(cell.getString() + ": " + str(e))
-                        elif args == "EditSelection":
-                            # Access the current selection
-                            try:
-                                #text_range.setString(text_range.getString() + ": " + user_input)
-                                url = self.get_config("endpoint", "http://127.0.0.1:5000") + "/v1/completions" 
-
-                                headers = {
-                                    'Content-Type': 'application/json'
-                                }
-
-                                prompt =  "ORIGINAL VERSION:\n" + cell.getString() + "\n Below is an edited version according to the following instructions. Don't waste time thinking, be as fast as you can. There are no comments in the edited version. USER INSTRUCTIONS: \n" + user_input + "\nEDITED VERSION:\n"
-
-                                if self.get_config("edit_selection_system_prompt", "") != "":
-                                    prompt = "SYSTEM PROMPT\n" + self.get_config("edit_selection_system_prompt","") + "\nEND SYSTEM PROMPT\n" + prompt
-
-
-                                data = {
-                                    'prompt':prompt,
-                                    'max_tokens': len(cell.getString()) + self.get_config("edit_selection_max_new_tokens", 0), # this is a bit hacky, it's actually number of characters + max new tokens, so even if max new tokens is zero, max_tokens will often end up with more tokens than the selected text actually contains.
-                                    'temperature': 1,
-                                    'top_p': 0.9,
-                                    'seed': 10
-                                }
-
-                                model = self.get_config("model", "")
-                                if model != "":
-                                    data["model"] = model
-
-                                # Convert data to JSON format
-                                json_data = json.dumps(data).encode('utf-8')
-
-                                # Create a request object with the URL, data, and headers
-                                request = urllib.request.Request(url, data=json_data, headers=headers, method='POST')
-
-                                # Send the request and read the response
-                                with urllib.request.urlopen(request) as response:
-                                    response_data = response.read()
-
-                                # If needed, decode the response data
-                                response = json.loads(response_data.decode('utf-8'))
+                # every range of a multi-selection, possibly on several sheets
+                if selection.supportsService("com.sun.star.sheet.SheetCellRanges"):
+                    areas = selection.getRangeAddresses()
+                else:
+                    areas = [selection.getRangeAddress()]
 
-
-                                # get previous selected text
-                                selected_text = cell.getString()
-
-                    
-                                raw_response = response["choices"][0]["text"]
-
-                                #action, rather than thought
-                                new_text = re.sub(r'<think>.*?</think>', '', raw_response, flags=re.DOTALL)
-
-                                # Set the new text for the cell
-                                cell.setString(new_text)
-
-
-                            except Exception as e:
-                                # Append the user input to the selected text
-                                cell.setString(cell.getString() + ": " + str(e))
-                        
-                        elif args == "settings":
-                            try:
-
-                                result = self.settings_box("Settings")
-                                                
-                                if "extend_selection_max_tokens" in result:
-                                    self.set_config("extend_selection_max_tokens", result["extend_selection_max_tokens"])
-
-                                if "extend_selection_system_prompt" in result:
-                                    self.set_config("extend_selection_system_prompt", result["extend_selection_system_prompt"])
-
-                                if "edit_selection_max_new_tokens" in result:
-                                    self.set_config("edit_selection_max_new_tokens", result["edit_selection_max_new_tokens"])
-
-                                if "edit_selection_system_prompt" in result:
-                                    self.set_config("edit_selection_system_prompt", result["edit_selection_system_prompt"])
-
-                                if "endpoint" in result and result["endpoint"].startswith("http"):
-                                    self.set_config("endpoint", result["endpoint"])
-
-                                if "model" in result:                
-                                    self.set_config("model", result["model"])
-
-
-                            except Exception as e:
-                                # Append the user input to the selected text
-                                cell.setString(cell.getString() + ":error: " + str(e))
+                ranges = []
+                for area in areas:
+                    # read each range at once instead of one getCellByPosition per cell
+                    cell_range = model.Sheets.getByIndex(area.Sheet).getCellRangeByPosition(area.StartColumn, area.StartRow, area.EndColumn, area.EndRow)
+                    ranges.append((cell_range, cell_range.getDataArray(), None))
+                self.submit_calc_job(args, ranges, user_input, document=model)
             except Exception as e:
-                pass
-
-# Starting from Python IDE
+                self.report_errors("calc " + str(args) + " failed", [str(e)])
+
+# ---- headless batch runs over many documents, see main() ----
+
+BATCH_EXTENSIONS = (".odt", ".ods")
+# one JSON object per processed document, kept in the output directory
+BATCH_CHECKPOINT = "localwriter_batch.jsonl"
+
+
+def property_values(values):
+    # dict as a sequence of com.sun.star.beans.PropertyValue, e.g. for loadComponentFromURL
+    properties = []
+    for name, value in values.items():
+        prop = uno.createUnoStruct("com.sun.star.beans.PropertyValue")
+        prop.Name = name
+        prop.Value = value
+        properties.append(prop)
+    return tuple(properties)
+
+
+def wait_for_main_thread(ctx, timeout=None):
+    # everything queued with run_on_main_thread before has run once this returns True
+    done = threading.Event()
+    run_on_main_thread(ctx, done.set)
+    return done.wait(timeout)
+
+
+def batch_documents(source, output):
+    """ Returns (root, paths): the .odt and .ods files below the directory source, or the
+        ones listed one per line in the manifest file source. Outputs are stored under
+        output at their path relative to root. Files inside output are skipped.
+    """
+    output = os.path.abspath(output)
+    if os.path.isdir(source):
+        root = os.path.abspath(source)
+        paths = []
+        for directory, subdirectories, files in os.walk(root):
+            subdirectories[:] = sorted(d for d in subdirectories if os.path.join(directory, d) != output)
+            paths.extend(os.path.join(directory, f) for f in sorted(files) if f.lower().endswith(BATCH_EXTENSIONS))
+        return root, paths
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, encoding="utf-8") as manifest:
+        lines = [line.strip() for line in manifest]
+    # relative entries are relative to the manifest, blank lines and # comments are ignored
+    paths = [os.path.normpath(os.path.join(base, line)) for line in lines if line and not line.startswith("#")]
+    root = os.path.commonpath([os.path.dirname(path) for path in paths]) if paths else base
+    return root, paths
+
+
+def read_checkpoint(path):
+    # the last record of each document in a checkpoint file, by document path
+    records = {}
+    try:
+        with open(path, encoding="utf-8") as checkpoint:
+            for line in checkpoint:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line of an interrupted run may be cut off
+                    continue
+                records[record.get("path")] = record
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def start_office(soffice, profile):
+    """ Starts a headless office with its own user profile, so several can run next to each
+        other and next to a desktop session, and returns (process, component context).
+        Like officehelper.bootstrap(), but headless and without touching the user's profile.
+    """
+    import random
+    import subprocess
+    from com.sun.star.connection import NoConnectException
+    pipe = "localwriter" + str(random.random())[2:]
+    process = subprocess.Popen([soffice, "--headless", "--invisible", "--nologo", "--nodefault", "--norestore", "--nolockcheck",
+                                "-env:UserInstallation=" + uno.systemPathToFileUrl(profile),
+                                "--accept=pipe,name=" + pipe + ";urp;"])
+    local_ctx = uno.getComponentContext()
+    resolver = local_ctx.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local_ctx)
+    deadline = time.monotonic() + 60
+    while True:
+        try:
+            return process, resolver.resolve("uno:pipe,name=" + pipe + ";urp;StarOffice.ComponentContext")
+        except NoConnectException:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError("could not start " + soffice)
+            time.sleep(0.5)
+
+
+# component context of the office of a batch worker process
+_batch_ctx = None
+
+
+def batch_worker_init(soffice, config):
+    """ Runs once in each batch worker process: starts its office and, when config is
+        given, reads the settings from that localwriter.json instead of the new profile.
+    """
+    global _batch_ctx, _config_store
+    import atexit
+    import shutil
+    import tempfile
+    profile = tempfile.mkdtemp(prefix="localwriter-office-")
+    process, _batch_ctx = start_office(soffice, profile)
+    if config:
+        _config_store = ConfigStore(os.path.abspath(config))
+
+    def stop():
+        try:
+            get_service(_batch_ctx, "com.sun.star.frame.Desktop").terminate()
+            process.wait(30)
+        except Exception:
+            process.kill()
+        shutil.rmtree(profile, ignore_errors=True)
+    atexit.register(stop)
+
+
+def batch_targets(document, target):
+    """ Returns the text ranges (Writer) or cell ranges (Calc) of document named by target:
+        ("document", None) for all of it, ("ranges", names) for bookmarks or text sections
+        in Writer and named ranges in Calc, ("columns", letters) for the used part of
+        these columns on every sheet.
+    """
+    kind, names = target
+    if hasattr(document, "Text"):
+        text = document.Text
+        if kind == "document":
+            cursor = text.createTextCursor()
+            cursor.gotoStart(False)
+            cursor.gotoEnd(True)
+            return [cursor]
+        if kind == "columns":
+            raise RuntimeError("columns only apply to spreadsheets")
+        bookmarks = document.getBookmarks()
+        sections = document.getTextSections()
+        ranges = []
+        for name in names:
+            if bookmarks.hasByName(name):
+                ranges.append(bookmarks.getByName(name).getAnchor())
+            elif sections.hasByName(name):
+                ranges.append(sections.getByName(name).getAnchor())
+            else:
+                raise RuntimeError("no bookmark or section named " + name)
+        return ranges
+
+    if kind == "ranges":
+        ranges = []
+        for name in names:
+            if not document.NamedRanges.hasByName(name):
+                raise RuntimeError("no named range " + name)
+            ranges.append(document.NamedRanges.getByName(name).getReferredCells())
+        return ranges
+    ranges = []
+    for index in range(document.Sheets.getCount()):
+        sheet = document.Sheets.getByIndex(index)
+        cursor = sheet.createCursor()
+        cursor.gotoStartOfUsedArea(False)
+        cursor.gotoEndOfUsedArea(True)
+        used = cursor.getRangeAddress()
+        if kind == "document":
+            ranges.append(sheet.getCellRangeByPosition(used.StartColumn, used.StartRow, used.EndColumn, used.EndRow))
+            continue
+        for letter in names:
+            column = sheet.getColumns().getByName(letter).getRangeAddress().StartColumn
+            ranges.append(sheet.getCellRangeByPosition(column, 0, column, used.EndRow))
+    return ranges
+
+
+def batch_document(path, output, command, instruction, target):
+    """ Runs command ("ExtendSelection" or "EditSelection") over the target of the document
+        at path, like the menu entry on a selection, and stores the result as output.
+        Called in a batch worker process, returns the number of seconds it took.
+    """
+    started = time.perf_counter()
+    job = MainJob(_batch_ctx)
+    job.errors = []
+    try:
+        document = job.desktop.loadComponentFromURL(uno.systemPathToFileUrl(path), "_blank", 0, property_values({"Hidden": True}))
+    except Exception as e:
+        # UNO exceptions can't be sent back to the main process
+        raise RuntimeError("could not open " + path + ": " + str(e))
+    if document is None:
+        raise RuntimeError("could not open " + path)
+    try:
+        ranges = batch_targets(document, target)
+        if hasattr(document, "Text"):
+            if command == "EditSelection":
+                chunks = []
+                for text_range in ranges:
+                    chunks.extend(job.edit_selection_chunks(text_range) or [text_range.getText().createTextCursorByRange(text_range)])
+                generation = job.submit_chunked_edit_job(command, chunks, instruction, document)
+            else:
+                generation = job.submit_writer_job(command, job.extend_selection_targets(command, ranges, document), document=document)
+        else:
+            cell_ranges = []
+            for cell_range in ranges:
+                data_array = cell_range.getDataArray()
+                # only cells with contents, a batch run has no selection to respect
+                cells = [(r, c) for r, row in enumerate(data_array) for c, value in enumerate(row) if value != ""]
+                if cells:
+                    cell_ranges.append((cell_range, data_array, cells))
+            generation = job.submit_calc_job(command, cell_ranges, instruction, document=document)
+        generation.wait()
+        # the job's last writes may still be queued for the office's main thread
+        wait_for_main_thread(job.ctx)
+        if generation.error is not None:
+            raise RuntimeError(str(generation.error))
+        if job.errors:
+            raise RuntimeError("; ".join(job.errors[:3]) + (" and " + str(len(job.errors) - 3) + " more" if len(job.errors) > 3 else ""))
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        # written next to the output and renamed, so an interrupted run never leaves half a file behind
+        partial = output + ".part"
+        document.storeToURL(uno.systemPathToFileUrl(partial), property_values({"Overwrite": True}))
+        os.replace(partial, output)
+    except RuntimeError:
+        raise
+    except Exception as e:
+        raise RuntimeError(str(e))
+    finally:
+        document.close(True)
+    return time.perf_counter() - started
+
+
+def run_batch(argv):
+    """ Command line entry point of batch runs, returns the exit status."""
+    import argparse
+    import concurrent.futures
+    import multiprocessing
+    parser = argparse.ArgumentParser(prog="python main.py",
+                                     description="Run Extend Selection or Edit Selection over many documents in headless offices.")
+    parser.add_argument("source", help="directory with .odt/.ods files, or a manifest file listing one document per line")
+    parser.add_argument("--output", required=True, help="directory for the processed documents and the checkpoint")
+    command = parser.add_mutually_exclusive_group(required=True)
+    command.add_argument("--edit", metavar="INSTRUCTIONS", help="edit the target according to INSTRUCTIONS")
+    command.add_argument("--extend", action="store_true", help="extend the target")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--ranges", metavar="NAMES", help="comma separated bookmarks or text sections (Writer) or named ranges (Calc) instead of the whole document")
+    target.add_argument("--columns", metavar="LETTERS", help="comma separated columns of every sheet (Calc) instead of the whole document")
+    parser.add_argument("--offices", type=int, default=1, help="headless offices run at the same time, one document each (default 1)")
+    parser.add_argument("--soffice", default=os.path.join(os.environ.get("UNO_PATH", ""), "soffice"), help="office executable (default soffice from UNO_PATH)")
+    parser.add_argument("--config", help="localwriter.json with the settings to use (default: the settings of the new headless profile)")
+    args = parser.parse_args(argv)
+
+    if args.ranges:
+        target = ("ranges", [name.strip() for name in args.ranges.split(",") if name.strip()])
+    elif args.columns:
+        target = ("columns", [letter.strip().upper() for letter in args.columns.split(",") if letter.strip()])
+    else:
+        target = ("document", None)
+    name = "EditSelection" if args.edit is not None else "ExtendSelection"
+
+    root, paths = batch_documents(args.source, args.output)
+    os.makedirs(args.output, exist_ok=True)
+    checkpoint_path = os.path.join(args.output, BATCH_CHECKPOINT)
+    # documents that were stored by an earlier run are skipped, failed ones are tried again
+    finished = {path for path, record in read_checkpoint(checkpoint_path).items() if record.get("status") == "done"}
+    todo = [path for path in paths if path not in finished]
+    print(str(len(paths)) + " documents, " + str(len(paths) - len(todo)) + " already done")
+    failed = 0
+    with open(checkpoint_path, "a", encoding="utf-8") as checkpoint, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=max(1, args.offices), mp_context=multiprocessing.get_context("spawn"),
+                                                   initializer=batch_worker_init, initargs=(args.soffice, args.config)) as pool:
+        futures = {pool.submit(batch_document, path, os.path.join(os.path.abspath(args.output), os.path.relpath(path, root)),
+                               name, args.edit or "", target): path for path in todo}
+        for count, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            path = futures[future]
+            record = {"path": path, "time": round(time.time(), 3)}
+            try:
+                record["seconds"] = round(future.result(), 2)
+                record["status"] = "done"
+            except Exception as e:
+                record["status"] = "failed"
+                record["error"] = str(e)
+                failed += 1
+            checkpoint.write(json.dumps(record) + "\n")
+            # flushed per document, so an interrupted run resumes after the last stored one
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+            print("[" + str(count) + "/" + str(len(todo)) + "] " + record["status"] + ": " + path
+                  + (" (" + str(record["seconds"]) + " s)" if "seconds" in record else ": " + record.get("error", "")))
+    print(str(len(todo) - failed) + " done, " + str(failed) + " failed")
+    return 1 if failed else 0
+
+
+# Starting from Python IDE, or from the command line with arguments for a batch run
 def main():
     try:
         ctx = XSCRIPTCONTEXT
     except NameError:
+        if len(sys.argv) > 1:
+            sys.exit(run_batch(sys.argv[1:]))
+        import officehelper
         ctx = officehelper.bootstrap()
         if ctx is None:
             print("ERROR: Could not bootstrap default Office.")